@@ -64,7 +64,8 @@ class Backend(GObject.GObject):
         'started': (GObject.SignalFlags.RUN_FIRST, None, ([])),
         'progress': (GObject.SignalFlags.RUN_FIRST, None, ([float])),
         'finished': (GObject.SignalFlags.RUN_FIRST, None, ([])),
-        'cancelled': (GObject.SignalFlags.RUN_FIRST, None, ([]))}
+        'cancelled': (GObject.SignalFlags.RUN_FIRST, None, ([])),
+        'failed': (GObject.SignalFlags.RUN_FIRST, None, ([str]))}
 
     def verify_preconditions(self):
         raise NotImplementedError()
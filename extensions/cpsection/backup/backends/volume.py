@@ -14,11 +14,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import gzip
+import json
 import shutil
+import hashlib
 import statvfs
 import tarfile
+import zlib
+import bisect
+import struct
 import logging
+import tempfile
+import multiprocessing
+from collections import deque
 from datetime import datetime
+from threading import Thread, Lock
+from multiprocessing.pool import ThreadPool
 
 from gettext import gettext as _
 from gi.repository import Gio
@@ -36,14 +47,32 @@ DS_SOURCE_NAME = 'datastore'
 SN_PATH_X86 = '/ofw/serial-number/serial-number'
 SN_PATH_ARM = '/proc/device-tree/serial-number'
 
+MODE_FULL = 'full'
+MODE_INCREMENTAL = 'incremental'
+
+MANIFEST_VERSION = 1
+# hidden, so the Journal doesn't list the objects of the store
+STORE_NAME = '.%s.xobstore'
+COPY_BLOCK_SIZE = 64 * 1024
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+INDEX_VERSION = 1
+INDEX_FOOTER_ID = 'XI'
+INDEX_FOOTER_SIZE = 42
+ENTRY_DIRECTORY = 'd'
+ENTRY_FILE = 'f'
+ENTRY_OTHER = 'o'
+
 
 class Backup(Backend):
 
     BACKUP_NAME = '%s_%s.xob'
+    MANIFEST_NAME = '%s_%s.xobm'
 
     def __init__(self):
         Backend.__init__(self)
         self._volume = None
+        self._mode = None
         self._percent = 0
 
     def _set_volume(self, option):
@@ -67,13 +96,30 @@ class Backup(Backend):
 
         raise PreConditionsChoose(_('Select your volume'), volume_options)
 
+    def _set_mode(self, option):
+        if self._mode is not None:
+            return
+
+        if option is not None and 'mode' in option:
+            self._mode = option['mode']
+            return
+
+        raise PreConditionsChoose(_('Select the type of backup'),
+                                  _get_mode_options())
+
     def verify_preconditions(self, option=None):
         """
         option: dictionary
         """
         self._set_volume(option)
+        self._set_mode(option)
         self._uncompressed_size = _get_datastore_size()
-        if _get_volume_space(self._volume) < self._uncompressed_size:
+        if self._mode == MODE_INCREMENTAL:
+            # only the files changed since the previous backup are stored
+            required_size = _get_changed_size(self._volume)
+        else:
+            required_size = self._uncompressed_size
+        if _get_volume_space(self._volume) < required_size:
             raise PreConditionsError(_('Not enough space in volume'))
 
     def _get_datastore_entries(self):
@@ -87,35 +133,147 @@ class Backup(Backend):
         return entries
 
     def _generate_checkpoint(self):
-        backup_file_name = self.BACKUP_NAME % (
+        if self._mode == MODE_INCREMENTAL:
+            name = self.MANIFEST_NAME
+        else:
+            name = self.BACKUP_NAME
+        backup_file_name = name % (
             _get_identifier(), datetime.now().strftime('%Y%m%d'))
         backup_file_name = get_valid_file_name(backup_file_name)
         return os.path.join(self._volume, backup_file_name)
 
-    def _do_continue(self):
-        self._tarfile.add(self._entries.pop())
-        percent = int((1.0 - float(len(self._entries)) / self._total) * 100)
+    def _update_progress(self, done_bytes):
+        # called from the backup thread
+        fraction = min(float(done_bytes) / max(self._uncompressed_size, 1),
+                       1.0)
+        percent = int(fraction * 100)
         if percent != self._percent:
             self._percent = percent
             logging.debug('backup-local progress is %f', percent)
-            self.emit('progress', float(percent) / 100.0)
+            GObject.idle_add(self.emit, 'progress', float(percent) / 100.0)
+
+    def _run(self, backup_func):
+        try:
+            finished = backup_func()
+        except Exception as e:
+            logging.exception('Backup to %s failed', self._checkpoint)
+            GObject.idle_add(self._do_fail, str(e))
+            return
 
-        if self._cancelled:
-            self._do_cancel()
-        elif len(self._entries) == 0:
-            self._do_finish()
+        if finished:
+            GObject.idle_add(self._do_finish)
         else:
-            GObject.idle_add(self._do_continue)
+            GObject.idle_add(self._do_cancel)
+
+    def _backup_full(self):
+        writer = _ParallelGzipWriter(open(self._checkpoint, 'wb'))
+        tar = tarfile.open(fileobj=writer, mode='w|')
+        # name, type, size and offset in the tar stream of each entry
+        entries = []
+        try:
+            for entry in self._get_datastore_entries():
+                for path in _walk_paths(entry):
+                    if self._cancelled:
+                        return False
+                    self._add_to_tar(tar, path, entries)
+                    self._update_progress(writer.get_size())
+
+            tar.close()
+            writer.flush()
+            _write_index(writer, entries, self._uncompressed_size)
+        finally:
+            tar.close()
+            writer.close()
+        return True
+
+    def _add_to_tar(self, tar, path, entries):
+        tarinfo = tar.gettarinfo(path)
+        if tarinfo is None:
+            # sockets and such can't be archived
+            return
+
+        offset = tar.offset
+        if tarinfo.isreg():
+            with open(path, 'rb') as file_object:
+                tar.addfile(tarinfo, file_object)
+            entry_type = ENTRY_FILE
+        else:
+            tar.addfile(tarinfo)
+            if tarinfo.isdir():
+                entry_type = ENTRY_DIRECTORY
+            else:
+                entry_type = ENTRY_OTHER
+        entries.append([tarinfo.name, entry_type, tarinfo.size, offset])
+
+    def _backup_incremental(self):
+        self._store_path = _get_store_path(self._volume)
+        self._previous_files = _get_previous_files(self._volume,
+                                                   self._store_path)
+        self._ds_path = _get_datastore_path()
+        directories, entries = _list_tree(self._ds_path)
+
+        # hashing and compressing release the GIL, do several files at once
+        pool = ThreadPool(_get_cpu_count())
+        records = []
+        done_bytes = DIR_SIZE * len(directories)
+        try:
+            for record in pool.imap_unordered(self._backup_file, entries):
+                if self._cancelled:
+                    # the objects already stored are reused by the next
+                    # backup
+                    return False
+                if record is not None:
+                    records.append(record)
+                    done_bytes += record['size']
+                    self._update_progress(done_bytes)
+        finally:
+            pool.terminate()
+
+        records.sort(key=lambda record: record['path'])
+        manifest = {'version': MANIFEST_VERSION,
+                    'store': os.path.basename(self._store_path),
+                    'directories': directories,
+                    'files': records}
+        _write_manifest(self._checkpoint, manifest)
+        return True
+
+    def _remove_checkpoint(self):
+        if os.path.exists(self._checkpoint):
+            os.remove(self._checkpoint)
 
     def _do_cancel(self):
-        self._tarfile.close()
         logging.debug('Cancel backup operation, remove file %s',
                       self._checkpoint)
-        os.remove(self._checkpoint)
+        self._remove_checkpoint()
         self.emit('cancelled')
 
+    def _do_fail(self, message):
+        self._remove_checkpoint()
+        self.emit('failed', _('Backup failed: %s') % message)
+
+    def _backup_file(self, relative_path):
+        path = os.path.join(self._ds_path, relative_path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # removed since the tree was listed
+            return None
+
+        previous = self._previous_files.get(relative_path)
+        if _is_unchanged(previous, stat, self._store_path):
+            digest = previous['hash']
+        else:
+            digest = _hash_file(path)
+            if not _has_object(self._store_path, digest):
+                _store_object(self._store_path, digest, path)
+
+        return {'path': relative_path,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'mode': stat.st_mode & 0o7777,
+                'hash': digest}
+
     def _do_finish(self):
-        self._tarfile.close()
         # Add metadata to the file created
         metadata = model.get(self._checkpoint)
         metadata['description'] = _('Backup from user %s') % \
@@ -129,11 +287,16 @@ class Backup(Backend):
     def start(self):
         self.emit('started')
         self._checkpoint = self._generate_checkpoint()
-        self._tarfile = tarfile.open(self._checkpoint, 'w:gz')
-        self._entries = self._get_datastore_entries()
-        self._total = len(self._entries)
         self._cancelled = False
-        GObject.idle_add(self._do_continue)
+        if self._mode == MODE_INCREMENTAL:
+            backup_func = self._backup_incremental
+        else:
+            backup_func = self._backup_full
+
+        # keep the compression out of the main loop
+        thread = Thread(target=self._run, args=(backup_func,))
+        thread.daemon = True
+        thread.start()
 
     def cancel(self):
         self._cancelled = True
@@ -146,8 +309,10 @@ class Restore(Backend):
         self._volume = None
         self._checkpoint = None
         self._checkpoint_size = None
+        self._objects = None
         self._percent = 0
         self._cancellable = True
+        self._lock = Lock()
 
     def _reset_datastore(self):
         ''' erase all contents from current datastore '''
@@ -202,39 +367,214 @@ class Restore(Backend):
         self._checkpoint_size = _get_checkpoint_size(self._checkpoint)
 
     def verify_preconditions(self, option=None):
+        """
+        option: dictionary
+        An 'objects' list of Journal object ids restores only those objects,
+        keeping the rest of the Journal.
+        """
+        if option is not None and 'objects' in option:
+            self._objects = option['objects']
         self._set_volume(option)
         self._set_checkpoint(option)
         self._set_checkpoint_size()
         if _get_volume_space(env.get_profile_path()) < self._checkpoint_size:
             raise PreConditionsError(_('Not enough space in disk'))
 
-    def _do_continue(self):
-        tarinfo = self._tarfile.next()
-        if tarinfo is not None:
-            self._tarfile.extract(tarinfo, path='/')
-            self._bytes += DIR_SIZE if tarinfo.isdir() else tarinfo.size
-            percent = int(self._bytes / self._checkpoint_size * 100)
-            if percent != self._percent:
-                self._percent = percent
-                logging.debug('restore-local progress is %f', percent)
-                self.emit('progress', float(percent) / 100.0)
-            GObject.idle_add(self._do_continue)
-        else:
-            self._do_finish()
+    def _add_progress(self, size):
+        # called from the restore threads
+        with self._lock:
+            self._bytes += size
+            fraction = min(self._bytes / max(self._total_bytes, 1), 1.0)
+            percent = int(fraction * 100)
+            if percent == self._percent:
+                return
+            self._percent = percent
+        logging.debug('restore-local progress is %f', percent)
+        GObject.idle_add(self.emit, 'progress', float(percent) / 100.0)
+
+    def _is_selected(self, relative_path):
+        if self._objects is None:
+            return True
+        for object_id in self._objects:
+            object_path = os.path.join(object_id[:2], object_id)
+            if relative_path == object_path or \
+                    relative_path.startswith(object_path + os.sep):
+                return True
+        return False
+
+    def _prepare_datastore(self):
+        if self._objects is None:
+            self._reset_datastore()
+            return
+
+        ds_path = _get_datastore_path()
+        for object_id in self._objects:
+            object_path = os.path.join(ds_path, object_id[:2], object_id)
+            if os.path.exists(object_path):
+                shutil.rmtree(object_path)
+        # make the datastore rebuild its index on the next start
+        index_updated_path = os.path.join(ds_path, 'index_updated')
+        if os.path.exists(index_updated_path):
+            os.remove(index_updated_path)
+
+    def _run(self):
+        try:
+            restore_func = self._open_checkpoint()
+            # only erase the Journal once the checkpoint is known good
+            self._prepare_datastore()
+            restore_func()
+        except Exception as e:
+            logging.exception('Restore of %s failed', self._checkpoint)
+            GObject.idle_add(self._do_fail, str(e))
+            return
+        GObject.idle_add(self._do_finish)
+
+    def _open_checkpoint(self):
+        ''' read and check the checkpoint, return the function restoring it,
+        raise if it can't be restored '''
+        if _is_manifest(self._checkpoint):
+            manifest = _read_manifest(self._checkpoint)
+            store_path = os.path.join(os.path.dirname(self._checkpoint),
+                                      manifest['store'])
+            for record in manifest['files']:
+                if self._is_selected(record['path']) and \
+                        not _has_object(store_path, record['hash']):
+                    raise IOError('%s is missing from %s' %
+                                  (record['path'], store_path))
+            return lambda: self._restore_incremental(manifest, store_path)
+
+        index = _read_index(self._checkpoint)
+        if index is not None and _check_index(self._checkpoint, index):
+            return lambda: self._restore_indexed(index)
+
+        # raises if the archive doesn't start with a tar header
+        with tarfile.open(self._checkpoint, 'r:gz') as tar:
+            tar.next()
+        return self._restore_full
+
+    def _restore_full(self):
+        # checkpoints without an index have to be read from the start
+        self._total_bytes = self._checkpoint_size
+        with tarfile.open(self._checkpoint, 'r:gz') as tar:
+            for tarinfo in tar:
+                relative_path = _get_datastore_relative_path(tarinfo.name)
+                if relative_path is not None and \
+                        not self._is_selected(relative_path):
+                    continue
+                tar.extract(tarinfo, path='/')
+                self._add_progress(
+                    DIR_SIZE if tarinfo.isdir() else tarinfo.size)
+
+    def _restore_indexed(self, index):
+        entries = []
+        for position, entry in enumerate(index['entries']):
+            relative_path = _get_datastore_relative_path(entry[0])
+            if relative_path is None or self._is_selected(relative_path):
+                entries.append([position] + entry)
+        self._total_bytes = sum(
+            DIR_SIZE if entry[2] == ENTRY_DIRECTORY else entry[3]
+            for entry in entries)
+
+        for entry in entries:
+            if entry[2] == ENTRY_DIRECTORY:
+                path = os.path.join('/', entry[1])
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                self._add_progress(DIR_SIZE)
+
+        # split the files in runs of about the same size, each run is read
+        # from the archive independently of the others
+        files = [entry for entry in entries if entry[2] != ENTRY_DIRECTORY]
+        threads = _get_cpu_count()
+        run_size = max(sum(entry[3] for entry in files) / threads, 1)
+        runs = [[]]
+        size = 0
+        for entry in files:
+            if size >= run_size:
+                runs.append([])
+                size = 0
+            runs[-1].append(entry)
+            size += entry[3]
+
+        pool = ThreadPool(threads)
+        try:
+            # get() raises the errors of the runs
+            for result in pool.imap_unordered(self._restore_run, runs):
+                pass
+        finally:
+            pool.terminate()
+
+    def _restore_run(self, entries):
+        with open(self._checkpoint, 'rb') as archive:
+            tar = None
+            last_position = None
+            for position, name, entry_type, size, member, skip in entries:
+                if tar is None or position != last_position + 1:
+                    # jump to the gzip member holding the entry
+                    archive.seek(member)
+                    stream = gzip.GzipFile(fileobj=archive, mode='rb')
+                    while skip > 0:
+                        skip -= len(stream.read(min(skip, COPY_BLOCK_SIZE)))
+                    tar = tarfile.open(fileobj=stream, mode='r|')
+
+                tarinfo = tar.next()
+                if tarinfo is None or tarinfo.name != name:
+                    raise IOError('Index of %s doesn\'t match its contents' %
+                                  self._checkpoint)
+                tar.extract(tarinfo, path='/')
+                self._add_progress(size)
+                last_position = position
+
+    def _restore_incremental(self, manifest, store_path):
+        self._store_path = store_path
+        self._ds_path = _get_datastore_path()
+
+        directories = [relative_path
+                       for relative_path in manifest['directories']
+                       if self._is_selected(relative_path)]
+        records = [record for record in manifest['files']
+                   if self._is_selected(record['path'])]
+        self._total_bytes = DIR_SIZE * len(directories) + \
+            sum(record['size'] for record in records)
+
+        for relative_path in directories:
+            path = os.path.join(self._ds_path, relative_path)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._add_progress(DIR_SIZE)
+
+        pool = ThreadPool(_get_cpu_count())
+        try:
+            for result in pool.imap_unordered(self._restore_record, records):
+                pass
+        finally:
+            pool.terminate()
+
+    def _restore_record(self, record):
+        path = os.path.join(self._ds_path, record['path'])
+        _restore_object(self._store_path, record['hash'], path)
+        os.chmod(path, record['mode'])
+        os.utime(path, (record['mtime'], record['mtime']))
+        self._add_progress(record['size'])
 
     def _do_finish(self):
-        self._tarfile.close()
         self._cancellable = True
         self.emit('finished')
 
+    def _do_fail(self, message):
+        self._cancellable = True
+        self.emit('failed', _('Restore failed: %s') % message)
+
     def start(self):
         self._cancellable = False
         self.emit('started')
         logging.debug('Starting with checkpoint %s', self._checkpoint)
-        self._tarfile = tarfile.open(self._checkpoint, 'r:gz')
         self._bytes = 0.0
-        self._reset_datastore()
-        GObject.idle_add(self._do_continue)
+        self._total_bytes = self._checkpoint_size
+        # keep the decompression out of the main loop
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
 
     def cancel(self):
         if not self._cancellable:
@@ -242,28 +582,214 @@ class Restore(Backend):
             raise Exception()
 
 
+class _ParallelGzipWriter(object):
+    """
+    File-like object compressing what is written to it in blocks, each one
+    a gzip member of its own, on several threads. The members are written
+    in order, so the result is a regular (multi-member) gzip file.
+    """
+
+    def __init__(self, file_object, threads=None):
+        self._file = file_object
+        self._threads = threads or _get_cpu_count()
+        self._pool = ThreadPool(self._threads)
+        self._pending = deque()
+        self._buffer = []
+        self._buffer_size = 0
+        self._size = 0
+        self._compressed_size = 0
+        self._members = []
+
+    def get_size(self):
+        """The number of uncompressed bytes written"""
+        return self._size
+
+    def get_compressed_size(self):
+        return self._compressed_size
+
+    def get_members(self):
+        """The uncompressed and compressed offsets where each gzip member
+        written so far starts"""
+        return self._members
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._size += len(data)
+        if self._buffer_size >= COMPRESS_BLOCK_SIZE:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        if self._buffer:
+            block = ''.join(self._buffer)
+            self._buffer = []
+            start = self._size - self._buffer_size
+            self._buffer_size = 0
+            self._pending.append(
+                (start, self._pool.apply_async(_compress_block, (block,))))
+
+        # bound the memory used by the blocks being compressed
+        while len(self._pending) > self._threads * 2:
+            self._write_pending()
+
+    def _write_pending(self):
+        start, result = self._pending.popleft()
+        self._members.append((start, self._compressed_size))
+        self.write_raw(result.get())
+
+    def write_raw(self, data):
+        """Write data as is, after what has been written before"""
+        self._file.write(data)
+        self._compressed_size += len(data)
+
+    def flush(self):
+        self._flush_buffer()
+        while self._pending:
+            self._write_pending()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.terminate()
+            self._file.close()
+
+
+def _compress_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _walk_paths(top):
+    ''' top and the directories and files under it, parents first '''
+    yield top
+    for dir_path, dir_names, file_names in os.walk(top):
+        for name in dir_names + file_names:
+            yield os.path.join(dir_path, name)
+
+
 def _get_volume_space(path):
     stat = os.statvfs(path)
     return stat[statvfs.F_BSIZE] * stat[statvfs.F_BAVAIL]
 
 
+class _DirectorySizeCache(object):
+    """
+    du-like size accounting of a directory tree.
+
+    The size of the entries of each directory is kept together with the
+    mtime of the directory, which is only listed again when its mtime
+    changes. Files rewritten in place don't change the mtime of their
+    directory, so the directories of the Journal objects changed meanwhile
+    are invalidated explicitly. The directories less than cached_depth
+    levels below the root hold files that grow in place, like the index
+    of the datastore, and are always measured again.
+    """
+
+    def __init__(self, root, cached_depth=0):
+        self._root = root
+        self._cached_depth = cached_depth
+        # path -> (mtime, size of the entries, subdirectories)
+        self._directories = {}
+
+    def get_size(self):
+        return self._get_tree_size(self._root, 0)
+
+    def invalidate(self, path):
+        prefix = path + os.sep
+        for cached_path in self._directories.keys():
+            if cached_path == path or cached_path.startswith(prefix):
+                del self._directories[cached_path]
+
+    def _get_tree_size(self, path, depth):
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.invalidate(path)
+            return 0
+
+        cached = self._directories.get(path)
+        if cached is None or cached[0] != mtime or \
+                depth < self._cached_depth:
+            listing = (mtime,) + self._list_directory(path)
+            if cached is not None:
+                # the removed subdirectories won't be visited again
+                for subdirectory in set(cached[2]) - set(listing[2]):
+                    self.invalidate(subdirectory)
+            cached = listing
+            self._directories[path] = cached
+
+        size = cached[1]
+        for subdirectory in cached[2]:
+            size += self._get_tree_size(subdirectory, depth + 1)
+        return size
+
+    def _list_directory(self, path):
+        size = 0
+        subdirectories = []
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return size, subdirectories
+
+        for name in names:
+            entry_path = os.path.join(path, name)
+            try:
+                size += os.path.getsize(entry_path)
+            except OSError:
+                # removed while listing, the mtime of path changed too
+                continue
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                subdirectories.append(entry_path)
+        return size, subdirectories
+
+
+_datastore_size_cache = None
+
+
+def _datastore_object_changed_cb(sender, object_id, **kwargs):
+    # objects on removable devices are identified by their path
+    if os.sep not in object_id:
+        _datastore_size_cache.invalidate(
+            os.path.join(_get_datastore_path(), object_id[:2], object_id))
+
+
 def _get_datastore_size():
-    # XXX: is there a better way?
-    size = 0
-    for root, dirnames, filenames in os.walk(_get_datastore_path()):
-        for d in dirnames:
-            size += os.path.getsize(os.path.join(root, d))
-        for f in filenames:
-            size += os.path.getsize(os.path.join(root, f))
-    return size
+    global _datastore_size_cache
+
+    if _datastore_size_cache is None:
+        # only the directories of the objects, two levels below the root,
+        # are kept up to date by the Journal signals
+        _datastore_size_cache = _DirectorySizeCache(_get_datastore_path(),
+                                                    cached_depth=2)
+        model.updated.connect(_datastore_object_changed_cb)
+        model.deleted.connect(_datastore_object_changed_cb)
+    return _datastore_size_cache.get_size()
 
 
 def _get_checkpoint_size(path):
     # read information in the metadata
     metadata = model.get(path)
+    index = None
+    if 'uncompressed_size' not in metadata and not _is_manifest(path):
+        index = _read_index(path)
+
     if 'uncompressed_size' in metadata:
         size = int(metadata['uncompressed_size'])
         logging.error('size from metadata = %d', size)
+    elif _is_manifest(path):
+        manifest = _read_manifest(path)
+        size = DIR_SIZE * len(manifest['directories'])
+        size += sum(record['size'] for record in manifest['files'])
+    elif index is not None:
+        size = index['size']
     else:
         size = 0
         with tarfile.open(path, 'r:gz') as file:
@@ -272,6 +798,220 @@ def _get_checkpoint_size(path):
     return size
 
 
+def _make_index_footer(offset, length):
+    ''' an empty gzip member carrying the position of the index in the
+    extra field of its header, so the file is still a valid gzip file '''
+    extra = INDEX_FOOTER_ID + struct.pack('<HQQ', 16, offset, length)
+    header = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + \
+        struct.pack('<H', len(extra)) + extra
+    # an empty final deflate block, the crc32 and the size of no data
+    return header + '\x03\x00' + struct.pack('<II', 0, 0)
+
+
+def _write_index(writer, entries, size):
+    """
+    Append the index of the archive: for each entry the gzip member where
+    it starts and how much of the member's data comes before it.
+    """
+    members = writer.get_members()
+    starts = [member[0] for member in members]
+    index_entries = []
+    for name, entry_type, entry_size, offset in entries:
+        member = members[bisect.bisect_right(starts, offset) - 1]
+        index_entries.append([name, entry_type, entry_size, member[1],
+                              offset - member[0]])
+
+    index = {'version': INDEX_VERSION,
+             'size': size,
+             'entries': index_entries}
+    index_offset = writer.get_compressed_size()
+    index_data = _compress_block(json.dumps(index))
+    writer.write_raw(index_data)
+    writer.write_raw(_make_index_footer(index_offset, len(index_data)))
+
+
+def _read_index(path):
+    ''' the index of a checkpoint, None if it doesn't have one '''
+    try:
+        with open(path, 'rb') as archive:
+            archive.seek(0, os.SEEK_END)
+            if archive.tell() < INDEX_FOOTER_SIZE:
+                return None
+            archive.seek(-INDEX_FOOTER_SIZE, os.SEEK_END)
+            footer = archive.read(INDEX_FOOTER_SIZE)
+            if footer[:4] != '\x1f\x8b\x08\x04' or \
+                    footer[12:14] != INDEX_FOOTER_ID:
+                return None
+            offset, length = struct.unpack('<QQ', footer[16:32])
+            archive.seek(offset)
+            data = zlib.decompress(archive.read(length), 16 + zlib.MAX_WBITS)
+        index = json.loads(data)
+    except (IOError, ValueError, zlib.error, struct.error):
+        logging.exception('Error reading the index of %s', path)
+        return None
+
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def _check_index(path, index):
+    ''' whether the gzip members the index points to are where it says '''
+    members = set(entry[3] for entry in index['entries'])
+    try:
+        with open(path, 'rb') as archive:
+            for offset in members:
+                archive.seek(offset)
+                if archive.read(2) != '\x1f\x8b':
+                    logging.error('Index of %s doesn\'t match its contents',
+                                  path)
+                    return False
+    except IOError:
+        logging.exception('Error checking the index of %s', path)
+        return False
+    return True
+
+
+def _get_datastore_relative_path(name):
+    ''' path of an archive entry relative to the datastore, or None '''
+    ds_name = _get_datastore_path().lstrip(os.sep)
+    if name == ds_name:
+        return ''
+    if name.startswith(ds_name + os.sep):
+        return name[len(ds_name) + 1:]
+    return None
+
+
+def _is_manifest(path):
+    return path.endswith('.xobm')
+
+
+def _read_manifest(path):
+    with gzip.open(path, 'rb') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported backup manifest %s' % path)
+    return manifest
+
+
+def _write_manifest(path, manifest):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as temp_file:
+        with gzip.GzipFile(fileobj=temp_file, mode='wb') as manifest_file:
+            json.dump(manifest, manifest_file)
+    os.rename(temp_path, path)
+
+
+def _get_previous_files(volume, store_path):
+    ''' file records of the newest manifest stored in store_path '''
+    store_name = os.path.basename(store_path)
+    manifests = [os.path.join(volume, name) for name in os.listdir(volume)
+                 if _is_manifest(name)]
+    manifests.sort(key=os.path.getmtime, reverse=True)
+    for path in manifests:
+        try:
+            manifest = _read_manifest(path)
+        except (IOError, ValueError):
+            logging.exception('Error reading backup manifest %s', path)
+            continue
+        if manifest['store'] == store_name:
+            return dict((record['path'], record)
+                        for record in manifest['files'])
+    return {}
+
+
+def _get_store_path(volume):
+    return os.path.join(volume,
+                        get_valid_file_name(STORE_NAME % _get_identifier()))
+
+
+def _is_unchanged(previous, stat, store_path):
+    ''' whether a file is stored already, as found by the previous backup '''
+    return previous is not None and previous['size'] == stat.st_size and \
+        previous['mtime'] == stat.st_mtime and \
+        _has_object(store_path, previous['hash'])
+
+
+def _get_changed_size(volume):
+    ''' upper bound of what an incremental backup adds to the store of
+    volume: the files that changed since the previous backup, as they are
+    compressed but may be new '''
+    store_path = _get_store_path(volume)
+    previous_files = _get_previous_files(volume, store_path)
+    ds_path = _get_datastore_path()
+    directories, files = _list_tree(ds_path)
+    size = 0
+    for relative_path in files:
+        try:
+            stat = os.stat(os.path.join(ds_path, relative_path))
+        except OSError:
+            continue
+        if not _is_unchanged(previous_files.get(relative_path), stat,
+                             store_path):
+            size += stat.st_size
+    return size
+
+
+def _list_tree(root):
+    ''' relative paths of the directories and files under root '''
+    directories = []
+    files = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        relative_dir = os.path.relpath(dir_path, root)
+        if relative_dir != os.curdir:
+            directories.append(relative_dir)
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files.append(os.path.relpath(path, root))
+    return directories, files
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source:
+        while True:
+            data = source.read(COPY_BLOCK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _get_object_path(store_path, digest):
+    return os.path.join(store_path, 'objects', digest[:2], digest[2:])
+
+
+def _has_object(store_path, digest):
+    return os.path.exists(_get_object_path(store_path, digest))
+
+
+def _store_object(store_path, digest, source_path):
+    ''' copy a file, compressed, in the store under its digest '''
+    object_path = _get_object_path(store_path, digest)
+    object_dir = os.path.dirname(object_path)
+    if not os.path.isdir(object_dir):
+        os.makedirs(object_dir)
+
+    fd, temp_path = tempfile.mkstemp(dir=object_dir)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            with gzip.GzipFile(fileobj=temp_file, mode='wb') as target:
+                with open(source_path, 'rb') as source:
+                    shutil.copyfileobj(source, target, COPY_BLOCK_SIZE)
+        os.rename(temp_path, object_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def _restore_object(store_path, digest, target_path):
+    object_path = _get_object_path(store_path, digest)
+    with gzip.open(object_path, 'rb') as source:
+        with open(target_path, 'wb') as target:
+            shutil.copyfileobj(source, target, COPY_BLOCK_SIZE)
+
+
 def _get_identifier():
     path = None
     if os.path.exists(SN_PATH_X86):
@@ -300,7 +1040,7 @@ def _get_checkpoint_options(volume):
     options['options'] = []
 
     for checkpoint in os.listdir(volume):
-        if not checkpoint.endswith('.xob'):
+        if not checkpoint.endswith('.xob') and not _is_manifest(checkpoint):
             continue
         option = {}
         option['description'] = checkpoint
@@ -310,6 +1050,16 @@ def _get_checkpoint_options(volume):
     return options
 
 
+def _get_mode_options():
+    options = {}
+    options['parameter'] = 'mode'
+    options['options'] = [
+        {'description': _('Full backup'), 'value': MODE_FULL},
+        {'description': _('Incremental backup, only copying the changes'),
+         'value': MODE_INCREMENTAL}]
+    return options
+
+
 def _get_volume_options():
     options = {}
     options['parameter'] = 'volume'
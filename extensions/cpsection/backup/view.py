@@ -343,6 +343,7 @@ class OperationPanel(Gtk.Grid):
         self._operator.connect('progress', self.__operation_progress_cb)
         self._operator.connect('finished', self.__operation_finished_cb)
         self._operator.connect('cancelled', self.__operation_cancelled_cb)
+        self._operator.connect('failed', self.__operation_failed_cb)
 
         # disable the accept button until the operation finish
         self._view.props.is_valid = False
@@ -379,3 +380,7 @@ class OperationPanel(Gtk.Grid):
 
     def __operation_cancelled_cb(self, backend):
         self._view.props.is_valid = True
+
+    def __operation_failed_cb(self, backend, message):
+        self._show_error_message(message)
+        self._view.props.is_valid = True
@@ -17,6 +17,8 @@ import json
 import os
 import struct
 import time
+import logging
+from collections import deque
 
 import dbus
 from gi.repository import GLib
@@ -39,6 +41,196 @@ class StreamMonitor(object):
         self.on_close = None
 
 
+# Stop reading from a client while more than this many bytes it sent are
+# waiting to be written to a file, and start again below the low mark
+_WRITE_HIGH_WATER_MARK = 4 * 1024 * 1024
+_WRITE_LOW_WATER_MARK = 1024 * 1024
+
+
+class _StreamReader(object):
+    """
+    Serve the chunks requested over a stream from a file, with asynchronous
+    GIO reads. One read is in flight at a time; once a chunk has been sent
+    the next one, of the same size, is read ahead.
+
+    Each chunk is still copied out of the GBytes it was read into and once
+    more to put the stream id in front of it, as the websocket message has
+    to be a single string.
+    """
+
+    def __init__(self, send_cb):
+        self._send_cb = send_cb
+        self._stream = None
+        self._requests = deque()
+        self._chunk_size = None
+        self._ahead = ''
+        self._reading = False
+        self._eof = False
+        self._closed = False
+
+    def open(self, file_name):
+        file_object = Gio.File.new_for_path(file_name)
+        file_object.read_async(GLib.PRIORITY_DEFAULT, None,
+                               self.__open_cb, None)
+
+    def __open_cb(self, file_object, result, user_data):
+        try:
+            self._stream = file_object.read_finish(result)
+        except GLib.GError:
+            logging.exception('Error opening %s', file_object.get_path())
+            self._eof = True
+            self._send_pending()
+            return
+
+        if self._closed:
+            self._stream.close(None)
+        else:
+            self._process()
+
+    def request(self, size):
+        self._requests.append(size)
+        if self._stream is not None:
+            self._process()
+        elif self._eof:
+            self._send_pending()
+
+    def close(self):
+        self._closed = True
+        self._requests.clear()
+        if self._stream is not None and not self._reading:
+            self._stream.close(None)
+
+    def _send_pending(self):
+        # Nothing more can be read, answer the requests with what we have
+        while self._requests:
+            size = self._requests.popleft()
+            data, self._ahead = self._ahead[:size], self._ahead[size:]
+            self._send_cb(data)
+
+    def _process(self):
+        while self._requests and not self._reading:
+            size = self._requests[0]
+            if len(self._ahead) < size and not self._eof:
+                self._read(size - len(self._ahead))
+                return
+
+            self._requests.popleft()
+            if len(self._ahead) > size:
+                data, self._ahead = self._ahead[:size], self._ahead[size:]
+            else:
+                data, self._ahead = self._ahead, ''
+            self._chunk_size = size
+            self._send_cb(data)
+
+        if not self._reading and not self._eof and not self._ahead and \
+                self._chunk_size is not None:
+            self._read(self._chunk_size)
+
+    def _read(self, size):
+        self._reading = True
+        self._stream.read_bytes_async(size, GLib.PRIORITY_DEFAULT, None,
+                                      self.__read_cb, None)
+
+    def __read_cb(self, stream, result, user_data):
+        self._reading = False
+        if self._closed:
+            stream.close(None)
+            return
+
+        try:
+            data = stream.read_bytes_finish(result).get_data()
+        except GLib.GError:
+            logging.exception('Error reading stream')
+            data = ''
+
+        if data:
+            self._ahead += data
+        else:
+            self._eof = True
+        self._process()
+
+
+class _StreamWriter(object):
+    """
+    Write the chunks received over a stream to a file, with asynchronous
+    GIO writes. The chunks are queued while a write is in flight; pause_cb
+    is called when too many are queued, and resume_cb once enough of them
+    have been written.
+    """
+
+    def __init__(self, output_stream, pause_cb, resume_cb):
+        self._stream = output_stream
+        self._pause_cb = pause_cb
+        self._resume_cb = resume_cb
+        self._pending = deque()
+        self._pending_size = 0
+        self._paused = False
+        self._writing = False
+        self._error = None
+        self._close_cb = None
+
+    def write(self, data, offset=0):
+        chunk = GLib.Bytes.new(data)
+        if offset:
+            # A view on the chunk, without copying it again
+            chunk = GLib.Bytes.new_from_bytes(chunk, offset,
+                                              chunk.get_size() - offset)
+        self._pending.append(chunk)
+        self._pending_size += chunk.get_size()
+        if not self._paused and \
+                self._pending_size > _WRITE_HIGH_WATER_MARK:
+            self._paused = True
+            self._pause_cb()
+        self._write_next()
+
+    def close(self, close_cb):
+        """Close once the queued chunks are written, then call close_cb
+        with None or the error that occurred while writing"""
+        self._close_cb = close_cb
+        self._write_next()
+
+    def _write_next(self):
+        if self._writing:
+            return
+
+        if self._pending and self._error is None:
+            self._writing = True
+            self._stream.write_bytes_async(self._pending[0],
+                                           GLib.PRIORITY_DEFAULT, None,
+                                           self.__write_cb, None)
+        elif self._close_cb is not None:
+            self._pending.clear()
+            self._written(self._pending_size)
+            try:
+                self._stream.close(None)
+            except GLib.GError as error:
+                self._error = self._error or error
+            close_cb, self._close_cb = self._close_cb, None
+            close_cb(self._error)
+
+    def __write_cb(self, stream, result, user_data):
+        self._writing = False
+        chunk = self._pending.popleft()
+        try:
+            count = stream.write_bytes_finish(result)
+        except GLib.GError as error:
+            logging.exception('Error writing stream')
+            self._error = error
+            count = chunk.get_size()
+
+        if count < chunk.get_size():
+            self._pending.appendleft(GLib.Bytes.new_from_bytes(
+                chunk, count, chunk.get_size() - count))
+        self._written(count)
+        self._write_next()
+
+    def _written(self, count):
+        self._pending_size -= count
+        if self._paused and self._pending_size < _WRITE_LOW_WATER_MARK:
+            self._paused = False
+            self._resume_cb()
+
+
 class API(object):
 
     def __init__(self, client):
@@ -120,9 +312,12 @@ class DatastoreAPI(API):
         instance_path = os.path.join(activity_root, "instance")
 
         file_path = os.path.join(instance_path, "%i" % time.time())
-        file_object = open(file_path, "w")
+        output_stream = Gio.File.new_for_path(file_path).replace(
+            None, False, Gio.FileCreateFlags.NONE, None)
 
-        return file_path, file_object
+        return file_path, _StreamWriter(output_stream,
+                                        self._client.pause_reading,
+                                        self._client.resume_reading)
 
     def get_metadata(self, request):
         def get_properties_reply_handler(properties):
@@ -151,14 +346,7 @@ class DatastoreAPI(API):
 
     def load(self, request):
         def get_filename_reply_handler(file_name):
-            file_object = open(file_name)
-            info["file_object"] = file_object
-
-            if "requested_size" in info:
-                send_binary(file_object.read(info["requested_size"]))
-
-            if "stream_closed" in info:
-                info["file_object"].close()
+            reader.open(file_name)
 
         def get_properties_reply_handler(properties):
             self._client.send_result(request, [properties])
@@ -167,26 +355,21 @@ class DatastoreAPI(API):
             self._client.send_error(request, error)
 
         def send_binary(data):
-            self._client.send_binary(chr(stream_id) + data)
+            self._client.send_binary(stream_prefix + data)
 
         def on_data(data):
             size = struct.unpack("ii", data)[1]
-            if "file_object" in info:
-                send_binary(info["file_object"].read(size))
-            else:
-                info["requested_size"] = size
+            reader.request(size)
 
         def on_close(close_request):
-            if "file_object" in info:
-                info["file_object"].close()
-            else:
-                info["stream_closed"] = True
+            reader.close()
 
             self._client.send_result(close_request, [])
 
-        info = {}
-
         uid, stream_id = request["params"]
+        stream_prefix = chr(stream_id)
+
+        reader = _StreamReader(send_binary)
 
         self._data_store.get_filename(
             uid,
@@ -210,12 +393,18 @@ class DatastoreAPI(API):
             self._client.send_error(info["close_request"], error)
 
         def on_data(data):
-            file_object.write(data[1:])
+            # Skip the stream id
+            writer.write(data, 1)
 
         def on_close(close_request):
-            file_object.close()
-
             info["close_request"] = close_request
+            writer.close(writer_closed_cb)
+
+        def writer_closed_cb(error):
+            if error is not None:
+                error_handler(str(error))
+                return
+
             self._data_store.update(uid, metadata, file_path, True,
                                     reply_handler=reply_handler,
                                     error_handler=error_handler)
@@ -224,7 +413,7 @@ class DatastoreAPI(API):
 
         uid, metadata, stream_id = request["params"]
 
-        file_path, file_object = self._create_file()
+        file_path, writer = self._create_file()
 
         stream_monitor = self._client.stream_monitors[stream_id]
         stream_monitor.on_data = on_data
@@ -248,10 +437,33 @@ class APIClient(object):
 
     def __init__(self, session):
         self._session = session
+        self._pause_count = 0
+        self._read_held = False
 
         self.activity_id = None
         self.stream_monitors = {}
 
+    def pause_reading(self):
+        """Stop reading messages from the client until resume_reading()"""
+        self._pause_count += 1
+        if self._pause_count == 1:
+            # The session asks for more data with read_data() once it has
+            # handled what it got, hold that call while paused
+            self._session.read_data = self._hold_read_data
+
+    def resume_reading(self):
+        self._pause_count -= 1
+        if self._pause_count > 0:
+            return
+
+        del self._session.read_data
+        if self._read_held:
+            self._read_held = False
+            self._session.read_data()
+
+    def _hold_read_data(self):
+        self._read_held = True
+
     def send_result(self, request, result):
         response = {"result": result,
                     "error": None,
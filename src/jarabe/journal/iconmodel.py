@@ -53,12 +53,17 @@ class IconModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
         self._result_set = model.find(query, IconModel._PAGE_SIZE)
         self._temp_drag_file_path = None
 
+        # uid -> index of the rows waiting for their preview
+        self._loading_previews = {}
+
         # HACK: The view will tell us that it is resizing so the model can
         # avoid hitting D-Bus and disk.
         self.view_is_resizing = False
 
         self._result_set.ready.connect(self.__result_set_ready_cb)
         self._result_set.progress.connect(self.__result_set_progress_cb)
+        self._result_set.entries_added.connect(
+            self.__result_set_entries_added_cb)
 
     def __result_set_ready_cb(self, **kwargs):
         self.emit('ready')
@@ -66,6 +71,18 @@ class IconModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
     def __result_set_progress_cb(self, **kwargs):
         self.emit('progress')
 
+    def __result_set_entries_added_cb(self, positions, **kwargs):
+        # the result set is still being populated, grow the model, the
+        # rows from the first new one onward have moved
+        if self._last_requested_index >= positions[0]:
+            self._last_requested_index = None
+        for uid, index in self._loading_previews.items():
+            if index >= positions[0]:
+                del self._loading_previews[uid]
+        for position in positions:
+            path = Gtk.TreePath((position,))
+            self.row_inserted(path, self.get_iter(path))
+
     def setup(self):
         self._result_set.setup()
 
@@ -109,10 +126,25 @@ class IconModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
                                                         _('Untitled')))
         self._cached_row.append(title)
 
-        self._cached_row.append(metadata.get('preview', ''))
+        preview = model.get_preview(metadata['uid'],
+                                    self.__preview_loaded_cb)
+        if preview is None:
+            self._loading_previews[metadata['uid']] = index
+            preview = ''
+        self._cached_row.append(preview)
 
         return self._cached_row[column]
 
+    def __preview_loaded_cb(self, object_id, preview):
+        index = self._loading_previews.pop(object_id, None)
+        if index is None or index >= self._result_set.length:
+            return
+
+        if index == self._last_requested_index:
+            self._last_requested_index = None
+        path = Gtk.TreePath((index,))
+        self.row_changed(path, self.get_iter(path))
+
     def do_iter_nth_child(self, parent_iter, n):
         return (False, None)
 
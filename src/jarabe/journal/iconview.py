@@ -15,6 +15,7 @@
 
 import logging
 import time
+from collections import OrderedDict
 from gettext import gettext as _
 
 from gi.repository import GObject
@@ -29,17 +30,64 @@ from sugar3.graphics import style
 from sugar3.activity.activity import PREVIEW_SIZE
 
 
+# Maximum memory in bytes used by the decoded previews
+PIXBUF_CACHE_SIZE = 16 * 1024 * 1024
+
+
+class _PixbufCache(object):
+    """LRU cache of decoded and scaled previews
+
+    Pixbufs are keyed by the uid of the entry and a hash of the preview
+    data, and the cache is bounded by the memory used by the pixels.
+    """
+
+    def __init__(self, max_size):
+        self._pixbufs = OrderedDict()
+        self._size = 0
+        self._max_size = max_size
+
+    def get_pixbuf(self, uid, preview_data):
+        if not preview_data:
+            return None
+
+        # the hash of a string is computed only once
+        key = (uid, hash(preview_data))
+        if key in self._pixbufs:
+            pixbuf = self._pixbufs.pop(key)
+            self._pixbufs[key] = pixbuf
+            return pixbuf
+
+        pixbuf = get_preview_pixbuf(preview_data)
+        self._pixbufs[key] = pixbuf
+        self._size += self._get_pixbuf_size(pixbuf)
+        while self._size > self._max_size:
+            key_, old_pixbuf = self._pixbufs.popitem(last=False)
+            self._size -= self._get_pixbuf_size(old_pixbuf)
+        return pixbuf
+
+    def _get_pixbuf_size(self, pixbuf):
+        if pixbuf is None:
+            return 0
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+_pixbuf_cache = _PixbufCache(PIXBUF_CACHE_SIZE)
+
+
 class PreviewRenderer(Gtk.CellRendererPixbuf):
 
     def __init__(self, **kwds):
         Gtk.CellRendererPixbuf.__init__(self, **kwds)
+        self._uid = None
         self._preview_data = None
 
-    def set_preview_data(self, data):
+    def set_preview_data(self, uid, data):
+        self._uid = uid
         self._preview_data = data
 
     def do_render(self, cr, widget, background_area, cell_area, flags):
-        self.props.pixbuf = get_preview_pixbuf(self._preview_data)
+        self.props.pixbuf = _pixbuf_cache.get_pixbuf(self._uid,
+                                                     self._preview_data)
         Gtk.CellRendererPixbuf.do_render(self, cr, widget, background_area,
                                          cell_area, flags)
 
@@ -53,9 +101,10 @@ class PreviewRenderer(Gtk.CellRendererPixbuf):
 
 class PreviewIconView(Gtk.IconView):
 
-    def __init__(self, title_col, preview_col):
+    def __init__(self, uid_col, title_col, preview_col):
         Gtk.IconView.__init__(self)
 
+        self._uid_col = uid_col
         self._preview_col = preview_col
         self._title_col = title_col
 
@@ -74,8 +123,9 @@ class PreviewIconView(Gtk.IconView):
                                 self._title_data_func, None)
 
     def _preview_data_func(self, view, cell, store, i, data):
+        uid = store.get_value(i, self._uid_col)
         preview_data = store.get_value(i, self._preview_col)
-        cell.set_preview_data(preview_data)
+        cell.set_preview_data(uid, preview_data)
 
     def _title_data_func(self, view, cell, store, i, data):
         title = store.get_value(i, self._title_col)
@@ -111,7 +161,8 @@ class IconView(Gtk.Bin):
         self.add(self._scrolled_window)
         self._scrolled_window.show()
 
-        self.icon_view = PreviewIconView(IconModel.COLUMN_TITLE,
+        self.icon_view = PreviewIconView(IconModel.COLUMN_UID,
+                                         IconModel.COLUMN_TITLE,
                                          IconModel.COLUMN_PREVIEW)
         self.icon_view.connect('item-activated', self.__item_activated_cb)
 
@@ -142,10 +193,6 @@ class IconView(Gtk.Bin):
         uid = icon_view.get_model()[path][IconModel.COLUMN_UID]
         self.emit('entry-activated', uid)
 
-    def _thumb_data_func(self, view, cell, store, i, data):
-        preview_data = store.get_value(i, IconModel.COLUMN_PREVIEW)
-        cell.props.pixbuf = get_preview_pixbuf(preview_data)
-
     def __model_created_cb(self, sender, signal, object_id):
         if self._is_new_item_visible(object_id):
             self._set_dirty()
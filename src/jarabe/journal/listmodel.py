@@ -73,15 +73,16 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
     }
 
     _PAGE_SIZE = 10
+    _ROW_CACHE_SIZE = 100
 
     def __init__(self, query):
         GObject.GObject.__init__(self)
 
-        self._last_requested_index = None
+        # index -> tuple with the values of the columns
+        self._row_cache = {}
         self._temp_drag_file_uid = None
-        self._cached_row = None
         self._query = query
-        self._all_ids = []
+        self._all_ids = None
         t = time.time()
         self._result_set = model.find(query, ListModel._PAGE_SIZE)
         logging.debug('init resultset: %r', time.time() - t)
@@ -98,25 +99,51 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
 
         self._result_set.ready.connect(self.__result_set_ready_cb)
         self._result_set.progress.connect(self.__result_set_progress_cb)
+        self._result_set.entries_added.connect(
+            self.__result_set_entries_added_cb)
+        model.updated.connect(self.__model_updated_cb)
 
     def get_all_ids(self):
+        # only fetched when needed, as this can be a long list
+        if self._all_ids is None:
+            t = time.time()
+            self._all_ids = self._result_set.find_ids(self._query)
+            logging.debug('get all ids: %r', time.time() - t)
         return self._all_ids
 
     def __result_set_ready_cb(self, **kwargs):
-        t = time.time()
-        self._all_ids = self._result_set.find_ids(self._query)
-        logging.debug('get all ids: %r', time.time() - t)
+        self._all_ids = None
         self.emit('ready')
 
     def __result_set_progress_cb(self, **kwargs):
         self.emit('progress')
 
+    def __result_set_entries_added_cb(self, positions, **kwargs):
+        # the result set is still being populated, grow the model
+        for index in self._row_cache.keys():
+            if index >= positions[0]:
+                del self._row_cache[index]
+        self._all_ids = None
+        for position in positions:
+            path = Gtk.TreePath((position,))
+            self.row_inserted(path, self.get_iter(path))
+
     def setup(self, updated_callback=None):
         self._result_set.setup()
         self._updated_callback = updated_callback
 
     def stop(self):
         self._result_set.stop()
+        model.updated.disconnect(self.__model_updated_cb)
+
+    def __model_updated_cb(self, sender, signal, object_id):
+        self._row_cache.clear()
+
+    def invalidate_cache(self):
+        """Drop the cached column values, as the elapsed times shown for
+        the entries depend on the current time.
+        """
+        self._row_cache.clear()
 
     def get_metadata(self, path):
         return model.get(self[path][ListModel.COLUMN_UID])
@@ -136,12 +163,15 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
     def set_value(self, iterator, column, value):
         index = iterator.user_data
         self._result_set.seek(index)
-        metadata = self._result_set.read()
+        # the result set does not have all the properties, the preview
+        # for example, and the update must not drop any of them
+        metadata = model.get(self._result_set.read()['uid'])
         if column == ListModel.COLUMN_FAVORITE:
             metadata['keep'] = value
         if column == ListModel.COLUMN_TITLE:
             metadata['title'] = value
         self._updated_entries[metadata['uid']] = metadata
+        self._row_cache.pop(index, None)
         if self._updated_callback is not None:
             model.updated.disconnect(self._updated_callback)
         model.write(metadata, update_mtime=False,
@@ -157,32 +187,43 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
             return None
 
         index = iterator.user_data
-        if index == self._last_requested_index:
-            return self._cached_row[column]
-
-        if index >= self._result_set.length:
-            return None
-
+        row = self._row_cache.get(index)
+        if row is None:
+            if index >= self._result_set.length:
+                return None
+            row = self._get_row(index)
+            self._cache_row(index, row)
+        return row[column]
+
+    def _cache_row(self, index, row):
+        if len(self._row_cache) >= ListModel._ROW_CACHE_SIZE:
+            # keep the rows around the one being displayed
+            max_distance = ListModel._ROW_CACHE_SIZE / 2
+            for cached_index in self._row_cache.keys():
+                if abs(cached_index - index) >= max_distance:
+                    del self._row_cache[cached_index]
+        self._row_cache[index] = row
+
+    def _get_row(self, index):
         self._result_set.seek(index)
         metadata = self._result_set.read()
         metadata.update(self._updated_entries.get(metadata['uid'], {}))
 
-        self._last_requested_index = index
-        self._cached_row = []
-        self._cached_row.append(metadata['uid'])
-        self._cached_row.append(metadata.get('keep', '0') == '1')
-        self._cached_row.append(misc.get_icon_name(metadata))
+        row = []
+        row.append(metadata['uid'])
+        row.append(metadata.get('keep', '0') == '1')
+        row.append(misc.get_icon_name(metadata))
 
         if misc.is_activity_bundle(metadata):
             xo_color = XoColor('%s,%s' % (style.COLOR_BUTTON_GREY.get_svg(),
                                           style.COLOR_TRANSPARENT.get_svg()))
         else:
             xo_color = misc.get_icon_color(metadata)
-        self._cached_row.append(xo_color)
+        row.append(xo_color)
 
         title = GObject.markup_escape_text(metadata.get('title',
                                                         _('Untitled')))
-        self._cached_row.append('<b>%s</b>' % (title, ))
+        row.append('<b>%s</b>' % (title, ))
 
         try:
             timestamp = float(metadata.get('timestamp', 0))
@@ -190,27 +231,27 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
             timestamp_content = _('Unknown')
         else:
             timestamp_content = util.timestamp_to_elapsed_string(timestamp)
-        self._cached_row.append(timestamp_content)
+        row.append(timestamp_content)
 
         try:
             creation_time = float(metadata.get('creation_time'))
         except (TypeError, ValueError):
-            self._cached_row.append(_('Unknown'))
+            row.append(_('Unknown'))
         else:
-            self._cached_row.append(
+            row.append(
                 util.timestamp_to_elapsed_string(float(creation_time)))
 
         try:
             size = int(metadata.get('filesize'))
         except (TypeError, ValueError):
             size = None
-        self._cached_row.append(util.format_size(size))
+        row.append(util.format_size(size))
 
         try:
             progress = int(float(metadata.get('progress', 100)))
         except (TypeError, ValueError):
             progress = 100
-        self._cached_row.append(progress)
+        row.append(progress)
 
         buddies = []
         if metadata.get('buddies'):
@@ -233,12 +274,12 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
                     logging.warning('Malformed buddies for %r: %s',
                                     metadata['uid'], exception)
                 else:
-                    self._cached_row.append([nick, XoColor(color)])
+                    row.append([nick, XoColor(color)])
                     continue
 
-            self._cached_row.append(None)
+            row.append(None)
 
-        return self._cached_row[column]
+        return tuple(row)
 
     def do_iter_nth_child(self, parent_iter, n):
         return (False, None)
@@ -312,7 +353,7 @@ class ListModel(GObject.GObject, Gtk.TreeModel, Gtk.TreeDragSource):
         self._selected = selected
 
     def select_all(self):
-        self._selected = self._all_ids[:]
+        self._selected = self.get_all_ids()[:]
 
     def select_none(self):
         self._selected = []
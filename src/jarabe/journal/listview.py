@@ -632,6 +632,7 @@ class BaseListView(Gtk.Bin):
 
         path, end_path = visible_range
         tree_model = self.tree_view.get_model()
+        tree_model.invalidate_cache()
 
         while True:
             cel_rect = self.tree_view.get_cell_area(path,
@@ -18,6 +18,7 @@ import logging
 import time
 import os
 import hashlib
+from collections import OrderedDict
 from gettext import gettext as _
 
 from gi.repository import Gio
@@ -47,8 +48,76 @@ from jarabe.journal import journalwindow
 
 PROJECT_BUNDLE_ID = 'org.sugarlabs.Project'
 
+# Number of icons read from .xo entries that are kept
+_XO_ICONS_SIZE = 32
+
+# Icons resolved by get_icon_name(). The bundle icons are keyed by bundle
+# id and depend on the installed bundles, the icons read from .xo entries
+# are keyed by uid, in least recently used order.
+_bundle_icons = None
+_xo_icons = OrderedDict()
+_mime_icons = {}
+
+
+def _get_bundle_icon(bundle_id):
+    global _bundle_icons
+    if _bundle_icons is None:
+        _bundle_icons = {}
+        registry = bundleregistry.get_registry()
+        registry.connect('bundle-added', _bundles_changed_cb)
+        registry.connect('bundle-removed', _bundles_changed_cb)
+        registry.connect('bundle-changed', _bundles_changed_cb)
+
+    if bundle_id not in _bundle_icons:
+        file_name = None
+        activity_info = bundleregistry.get_registry().get_bundle(bundle_id)
+        if activity_info:
+            file_name = activity_info.get_icon()
+        _bundle_icons[bundle_id] = file_name
+    return _bundle_icons[bundle_id]
+
+
+def _bundles_changed_cb(registry, bundle):
+    _bundle_icons.clear()
+
+
+def _get_xo_icon(uid):
+    if uid in _xo_icons:
+        file_name = _xo_icons.pop(uid)
+        _xo_icons[uid] = file_name
+        return file_name
+
+    file_name = None
+    file_path = model.get_file(uid)
+    if file_path is not None and os.path.exists(file_path):
+        try:
+            bundle = get_bundle_instance(file_path)
+            # keep a reference, the icon is a temporary file extracted
+            # from the bundle and is deleted with its last reference
+            file_name = bundle.get_icon()
+        except Exception:
+            logging.exception('Could not read bundle')
+    _xo_icons[uid] = file_name
+    while len(_xo_icons) > _XO_ICONS_SIZE:
+        _xo_icons.popitem(last=False)
+    return file_name
+
+
+def _object_changed_cb(sender, signal, object_id):
+    _xo_icons.pop(object_id, None)
+
+
+model.updated.connect(_object_changed_cb)
+model.deleted.connect(_object_changed_cb)
+
 
 def _get_icon_for_mime(mime_type):
+    if mime_type not in _mime_icons:
+        _mime_icons[mime_type] = _find_icon_for_mime(mime_type)
+    return _mime_icons[mime_type]
+
+
+def _find_icon_for_mime(mime_type):
     generic_types = mime.get_all_generic_types()
     for generic_type in generic_types:
         if mime_type in generic_type.mime_types:
@@ -96,18 +165,10 @@ def get_icon_name(metadata):
                 'scalable/mimetypes/project-box.svg'
             return file_name
 
-        activity_info = bundleregistry.get_registry().get_bundle(bundle_id)
-        if activity_info:
-            file_name = activity_info.get_icon()
+        file_name = _get_bundle_icon(bundle_id)
 
     if file_name is None and is_activity_bundle(metadata):
-        file_path = model.get_file(metadata['uid'])
-        if file_path is not None and os.path.exists(file_path):
-            try:
-                bundle = get_bundle_instance(file_path)
-                file_name = bundle.get_icon()
-            except Exception:
-                logging.exception('Could not read bundle')
+        file_name = _get_xo_icon(metadata['uid'])
 
     if file_name is None:
         file_name = _get_icon_for_mime(metadata.get('mime_type', ''))
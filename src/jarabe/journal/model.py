@@ -22,17 +22,29 @@ import time
 import tempfile
 from stat import S_IFLNK, S_IFMT, S_IFDIR, S_IFREG
 import re
-from operator import itemgetter
+import bisect
+from collections import deque, OrderedDict
+from threading import Thread, Lock
 import json
+import hashlib
 from gettext import gettext as _
 
 import dbus
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from gi.repository import Gio
 from gi.repository import GLib
 
 from gi.repository import SugarExt
 
 from sugar3 import dispatch
+from sugar3 import env
 from sugar3 import mime
 from sugar3 import util
 
@@ -41,50 +53,86 @@ DS_DBUS_SERVICE = 'org.laptop.sugar.DataStore'
 DS_DBUS_INTERFACE = 'org.laptop.sugar.DataStore'
 DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
 
-# Properties the journal cares about.
+# Properties the journal cares about. Previews are loaded on demand with
+# get_preview().
 PROPERTIES = ['activity', 'activity_id', 'buddies', 'bundle_id',
               'creation_time', 'filesize', 'icon-color', 'keep', 'mime_type',
-              'mountpoint', 'mtime', 'progress', 'timestamp', 'title', 'uid',
-              'preview']
+              'mountpoint', 'mtime', 'progress', 'timestamp', 'title', 'uid']
+
+# Maximum size in bytes of the previews kept in memory
+PREVIEW_CACHE_SIZE = 8 * 1024 * 1024
+
+MAX_PAGES_TO_CACHE = 10
+MAX_PAGES_TO_PREFETCH = 3
 
-MIN_PAGES_TO_CACHE = 3
-MAX_PAGES_TO_CACHE = 5
+# Time we want the prefetched pages to last at the current scroll speed
+PREFETCH_LOOKAHEAD_TIME = 0.5
 
 JOURNAL_METADATA_DIR = '.Sugar-Metadata'
+JOURNAL_INDEX_DIR = 'journal-index'
+JOURNAL_INDEX_VERSION = 3
+
+# Time a volume scan works before handing its results to the main loop
+SCAN_BATCH_TIME = 0.1
+
+# Kinds of directory entries, as reported by the directory listing
+_ENTRY_DIRECTORY = 'd'
+_ENTRY_FILE = 'f'
+_ENTRY_LINK = 'l'
+_ENTRY_OTHER = 'o'
 
 _datastore = None
+_volume_indexes = {}
 created = dispatch.Signal()
 updated = dispatch.Signal()
 deleted = dispatch.Signal()
 
 
 class _Cache(object):
+    """LRU cache of the pages of a result set, keyed by page number
 
-    __gtype_name__ = 'model_Cache'
+    Pages do not need to be contiguous, so jumping around the result
+    set keeps the recently visited areas cached.
+    """
 
-    def __init__(self, entries=None):
-        self._array = []
+    def __init__(self, max_pages):
+        self._pages = OrderedDict()
+        self._max_pages = max_pages
+
+    def get(self, page):
+        entries = self._pages.pop(page, None)
         if entries is not None:
-            self.append_all(entries)
+            self._pages[page] = entries
+        return entries
 
-    def prepend_all(self, entries):
-        self._array[0:0] = entries
+    def add(self, page, entries):
+        self._pages.pop(page, None)
+        self._pages[page] = entries
+        while len(self._pages) > self._max_pages:
+            self._pages.popitem(last=False)
 
-    def append_all(self, entries):
-        self._array += entries
+    def clear(self):
+        self._pages.clear()
 
-    def __len__(self):
-        return len(self._array)
+    def discard_from(self, first_page):
+        """Drop the pages from first_page onward"""
+        for page in self._pages.keys():
+            if page >= first_page:
+                del self._pages[page]
 
-    def __getitem__(self, key):
-        return self._array[key]
+    def __contains__(self, page):
+        return page in self._pages
 
-    def __delitem__(self, key):
-        del self._array[key]
+    def __len__(self):
+        return len(self._pages)
 
 
 class BaseResultSet(object):
     """Encapsulates the result of a query
+
+    Entries are read one page at a time and kept in a LRU cache. The
+    direction and speed of the reads is tracked to fetch the pages that
+    will be needed next in advance, asynchronously.
     """
 
     def __init__(self, query, page_size):
@@ -93,11 +141,18 @@ class BaseResultSet(object):
         self._query = query
         self._page_size = page_size
 
-        self._offset = 0
-        self._cache = _Cache()
+        self._cache = _Cache(MAX_PAGES_TO_CACHE)
+        # page -> token of the prefetch running for it
+        self._pending_pages = {}
+
+        self._last_page = None
+        self._last_page_time = 0
+        self._direction = 1
+        self._velocity = 0
 
         self.ready = dispatch.Signal()
         self.progress = dispatch.Signal()
+        self.entries_added = dispatch.Signal()
 
     def setup(self):
         self.ready.send(self)
@@ -107,11 +162,7 @@ class BaseResultSet(object):
 
     def get_length(self):
         if self._total_count == -1:
-            query = self._query.copy()
-            query['limit'] = self._page_size * MIN_PAGES_TO_CACHE
-            entries, self._total_count = self.find(query)
-            self._cache.append_all(entries)
-            self._offset = 0
+            self._total_count = self.count(self._query)
         return self._total_count
 
     length = property(get_length)
@@ -119,87 +170,140 @@ class BaseResultSet(object):
     def find(self, query):
         raise NotImplementedError()
 
-    def seek(self, position):
-        self._position = position
-
-    def read(self):
-        if self._position == -1:
-            self.seek(0)
+    def find_ids(self, query):
+        raise NotImplementedError()
 
-        if self._position < self._offset:
-            remaining_forward_entries = 0
-        else:
-            remaining_forward_entries = self._offset + len(self._cache) - \
-                self._position
+    def count(self, query):
+        """Return the number of entries matching a query
 
-        if self._position > self._offset + len(self._cache):
-            remaining_backwards_entries = 0
-        else:
-            remaining_backwards_entries = self._position - self._offset
+        Subclasses should override this if they can count the entries
+        without fetching them.
+        """
+        query = query.copy()
+        query['limit'] = 1
+        entries_, total_count = self.find(query)
+        return total_count
 
-        last_cached_entry = self._offset + len(self._cache)
+    def find_async(self, query, reply_handler, error_handler):
+        """Asynchronous version of find()
 
-        if remaining_forward_entries <= 0 and remaining_backwards_entries <= 0:
+        reply_handler is called with the entries and the total count.
+        Subclasses that can query without blocking should override this.
+        """
+        def find_cb():
+            try:
+                entries, total_count = self.find(query)
+            except Exception as e:
+                error_handler(e)
+            else:
+                reply_handler(entries, total_count)
+            return False
 
-            # Total cache miss: remake it
-            limit = self._page_size * MIN_PAGES_TO_CACHE
-            offset = max(0, self._position - limit / 2)
-            logging.debug('remaking cache, offset: %r limit: %r', offset,
-                          limit)
-            query = self._query.copy()
-            query['limit'] = limit
-            query['offset'] = offset
-            entries, self._total_count = self.find(query)
+        GLib.idle_add(find_cb)
 
-            del self._cache[:]
-            self._cache.append_all(entries)
-            self._offset = offset
+    def seek(self, position):
+        self._position = position
 
-        elif (remaining_forward_entries <= 0 and
-              remaining_backwards_entries > 0):
+    def read(self):
+        if self._position == -1:
+            self.seek(0)
 
-            # Add one page to the end of cache
-            logging.debug('appending one more page, offset: %r',
-                          last_cached_entry)
-            query = self._query.copy()
-            query['limit'] = self._page_size
-            query['offset'] = last_cached_entry
-            entries, self._total_count = self.find(query)
+        page = self._position // self._page_size
+        entries = self._cache.get(page)
+        if entries is None:
+            logging.debug('cache miss, fetching page %r', page)
+            entries = self._fetch_page(page)
+
+        if self._update_scroll_state(page):
+            self._prefetch(page)
+
+        return entries[self._position - page * self._page_size]
+
+    def _invalidate_cache(self, first_position=0):
+        """Drop the cached entries from first_position onward"""
+        first_page = first_position // self._page_size
+        self._cache.discard_from(first_page)
+        # drop the replies of the prefetches still running for them
+        for page in self._pending_pages.keys():
+            if page >= first_page:
+                del self._pending_pages[page]
+
+    def _add_pages(self, first_page, entries):
+        for i in range(0, len(entries), self._page_size):
+            self._cache.add(first_page + i // self._page_size,
+                            entries[i:i + self._page_size])
+
+    def _get_page_query(self, page):
+        query = self._query.copy()
+        query['limit'] = self._page_size
+        query['offset'] = page * self._page_size
+        return query
+
+    def _fetch_page(self, page):
+        entries, self._total_count = self.find(self._get_page_query(page))
+        self._pending_pages.pop(page, None)
+        self._cache.add(page, entries)
+        return entries
+
+    def _update_scroll_state(self, page):
+        """Track the direction and speed, in pages per second, of reads
+
+        Returns True if a different page than in the last read was read.
+        """
+        if page == self._last_page:
+            return False
 
-            # update cache
-            self._cache.append_all(entries)
+        now = time.time()
+        if self._last_page is not None:
+            delta = page - self._last_page
+            self._direction = 1 if delta > 0 else -1
+            if abs(delta) > MAX_PAGES_TO_PREFETCH:
+                # a jump, not scrolling
+                self._velocity = 0
+            else:
+                elapsed = max(now - self._last_page_time, 0.001)
+                self._velocity = abs(delta) / elapsed
+
+        self._last_page = page
+        self._last_page_time = now
+        return True
 
-            # apply the cache limit
-            cache_limit = self._page_size * MAX_PAGES_TO_CACHE
-            objects_excess = len(self._cache) - cache_limit
-            if objects_excess > 0:
-                self._offset += objects_excess
-                del self._cache[:objects_excess]
+    def _prefetch(self, page):
+        pages_to_prefetch = 1 + int(self._velocity * PREFETCH_LOOKAHEAD_TIME)
+        pages_to_prefetch = min(pages_to_prefetch, MAX_PAGES_TO_PREFETCH)
 
-        elif remaining_forward_entries > 0 and \
-                remaining_backwards_entries <= 0 and self._offset > 0:
+        if self._total_count != -1:
+            last_page = (self._total_count - 1) // self._page_size
+        else:
+            last_page = page + pages_to_prefetch
 
-            # Add one page to the beginning of cache
-            limit = min(self._offset, self._page_size)
-            self._offset = max(0, self._offset - limit)
+        for i in range(1, pages_to_prefetch + 1):
+            next_page = page + i * self._direction
+            if next_page < 0 or next_page > last_page:
+                break
+            if next_page in self._cache or next_page in self._pending_pages:
+                continue
+            self._prefetch_page(next_page)
 
-            logging.debug('prepending one more page, offset: %r limit: %r',
-                          self._offset, limit)
-            query = self._query.copy()
-            query['limit'] = limit
-            query['offset'] = self._offset
-            entries, self._total_count = self.find(query)
+    def _prefetch_page(self, page):
+        token = object()
 
-            # update cache
-            self._cache.prepend_all(entries)
+        def reply_handler(entries, total_count):
+            if self._pending_pages.get(page) is not token:
+                return
+            del self._pending_pages[page]
+            self._total_count = total_count
+            self._cache.add(page, entries)
 
-            # apply the cache limit
-            cache_limit = self._page_size * MAX_PAGES_TO_CACHE
-            objects_excess = len(self._cache) - cache_limit
-            if objects_excess > 0:
-                del self._cache[-objects_excess:]
+        def error_handler(error):
+            if self._pending_pages.get(page) is token:
+                del self._pending_pages[page]
+            logging.error('Could not prefetch page %r: %s', page, error)
 
-        return self._cache[self._position - self._offset]
+        logging.debug('prefetching page %r', page)
+        self._pending_pages[page] = token
+        self.find_async(self._get_page_query(page), reply_handler,
+                        error_handler)
 
 
 class DatastoreResultSet(BaseResultSet):
@@ -230,11 +334,202 @@ class DatastoreResultSet(BaseResultSet):
 
         return entries, total_count
 
+    def find_async(self, query, reply_handler, error_handler):
+        def find_reply_cb(entries, total_count):
+            for entry in entries:
+                entry['mountpoint'] = '/'
+            reply_handler(entries, total_count)
+
+        _get_datastore().find(query, PROPERTIES, byte_arrays=True,
+                              reply_handler=find_reply_cb,
+                              error_handler=error_handler)
+
     def find_ids(self, query):
         copy = query.copy()
         copy.pop('mountpoints', '/')
         return _get_datastore().find_ids(copy)
 
+    def count(self, query):
+        # only ask for the uid, the total count comes with any query
+        copy = query.copy()
+        copy.pop('mountpoints', '/')
+        copy['limit'] = 1
+        entries_, total_count = _get_datastore().find(copy, ['uid'],
+                                                      byte_arrays=True)
+        return total_count
+
+
+class _VolumeIndex(object):
+    """Persistent index of the metadata of the files found on a volume
+
+    For every regular file seen by a scan the index keeps its mtime and
+    size together with the metadata parsed from the .Sugar-Metadata
+    directory and the mtime of the metadata file. A later scan of the same
+    volume still lists every directory, as directory mtimes can't be
+    trusted on FAT filesystems, but only reads the metadata of the files
+    that changed in the meantime.
+
+    Different devices can be mounted on the same path, so the index is
+    found by the UUID of the filesystem, and the files are stored by
+    their path relative to the mount point. Inode numbers aren't stable
+    across mounts of FAT filesystems and are not used.
+
+    The index is kept in memory for the lifetime of the shell and is
+    stored in the profile so it survives reboots.
+    """
+
+    def __init__(self, mount_point, volume_id):
+        self._mount_point = mount_point
+        if isinstance(volume_id, unicode):
+            volume_id = volume_id.encode('utf-8')
+        self._path = os.path.join(env.get_profile_path(JOURNAL_INDEX_DIR),
+                                  hashlib.sha1(volume_id).hexdigest())
+
+        # relative file path -> [mtime, size, metadata mtime, metadata]
+        self._files = {}
+        self._dirty = False
+
+        # Volumes are scanned in a worker thread
+        self._lock = Lock()
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+
+        try:
+            with open(self._path) as index_file:
+                data = json.load(index_file)
+        except (ValueError, EnvironmentError):
+            logging.exception('Could not read journal index %r', self._path)
+            return
+
+        if data.get('version') != JOURNAL_INDEX_VERSION:
+            return
+
+        # JSON gives back unicode, but the scan uses byte string paths
+        for file_path, record in data['files'].iteritems():
+            self._files[file_path.encode('utf-8')] = record
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'version': JOURNAL_INDEX_VERSION,
+                    'files': self._files.copy()}
+            self._dirty = False
+
+        # the index of a big volume takes a while to serialize, don't
+        # hold the scan meanwhile
+        try:
+            index_dir = os.path.dirname(self._path)
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            (fh, fn) = tempfile.mkstemp(dir=index_dir)
+            with os.fdopen(fh, 'w') as index_file:
+                json.dump(data, index_file)
+            os.rename(fn, self._path)
+        except (UnicodeDecodeError, EnvironmentError):
+            logging.exception('Could not write journal index %r', self._path)
+            with self._lock:
+                self._dirty = True
+
+    def start_scan(self):
+        """Return the set where a scan collects the paths it sees
+
+        Several scans of the same volume can run at once, each one passes
+        its own set to the lookups and to finish_scan().
+        """
+        return set()
+
+    def finish_scan(self, seen):
+        """Forget the files not seen by a complete scan"""
+        with self._lock:
+            for path in self._files.keys():
+                if path not in seen:
+                    del self._files[path]
+                    self._dirty = True
+
+    def _get_key(self, file_path):
+        return os.path.relpath(file_path, self._mount_point)
+
+    def get_file_metadata(self, file_path, stat, seen):
+        """Return a copy of the metadata stored for a file
+
+        None is returned if the file is not in the index, or if the file
+        or its metadata changed since it was indexed.
+        """
+        key = self._get_key(file_path)
+        with self._lock:
+            seen.add(key)
+            record = self._files.get(key)
+        if record is None:
+            return None
+
+        mtime, size, metadata_mtime, metadata = record
+        if mtime != stat.st_mtime or size != stat.st_size:
+            return None
+
+        if metadata_mtime != self._get_metadata_mtime(file_path):
+            return None
+
+        metadata = metadata.copy()
+        metadata['uid'] = file_path
+        return metadata
+
+    def set_file_metadata(self, file_path, stat, metadata):
+        metadata = metadata.copy()
+        metadata.pop('preview', None)
+        metadata.pop('mountpoint', None)
+        metadata.pop('uid', None)
+        metadata_mtime = self._get_metadata_mtime(file_path)
+        with self._lock:
+            self._files[self._get_key(file_path)] = \
+                [stat.st_mtime, stat.st_size, metadata_mtime, metadata]
+            self._dirty = True
+
+    def _get_metadata_mtime(self, file_path):
+        subdir = os.path.relpath(os.path.dirname(file_path),
+                                 self._mount_point)
+        metadata_path = os.path.normpath(os.path.join(
+            self._mount_point, JOURNAL_METADATA_DIR, subdir,
+            os.path.basename(file_path) + '.metadata'))
+        try:
+            return os.stat(metadata_path).st_mtime
+        except OSError:
+            return None
+
+
+def _get_volume_id(mount_point):
+    """Identify the filesystem mounted at mount_point, by its UUID if it
+    has one"""
+    try:
+        mount = Gio.File.new_for_path(mount_point).find_enclosing_mount(None)
+    except GLib.GError:
+        mount = None
+
+    if mount is not None:
+        uuid = mount.get_uuid()
+        volume = mount.get_volume()
+        if not uuid and volume is not None:
+            uuid = volume.get_identifier(Gio.VOLUME_IDENTIFIER_KIND_UUID)
+        if uuid:
+            return 'uuid:%s' % uuid
+
+    try:
+        device = os.stat(mount_point).st_dev
+    except OSError:
+        device = None
+    return 'device:%s:%s' % (device, mount_point)
+
+
+def _get_volume_index(mount_point):
+    key = (_get_volume_id(mount_point), mount_point)
+    if key not in _volume_indexes:
+        _volume_indexes[key] = _VolumeIndex(mount_point, key[0])
+    return _volume_indexes[key]
+
 
 class InplaceResultSet(BaseResultSet):
     """Encapsulates the result of a query on a mount point
@@ -243,10 +538,11 @@ class InplaceResultSet(BaseResultSet):
     def __init__(self, query, page_size, mount_point):
         BaseResultSet.__init__(self, query, page_size)
         self._mount_point = mount_point
+        self._index = _get_volume_index(mount_point)
         self._file_list = None
-        self._pending_directories = []
-        self._visited_directories = []
-        self._pending_files = []
+        self._seen = None
+        self._sort_keys = None
+        self._is_ready = False
         self._stopped = False
 
         query_text = query.get('query', '')
@@ -274,28 +570,62 @@ class InplaceResultSet(BaseResultSet):
         self._mime_types = query.get('mime_type', [])
 
         self._sort = query.get('order_by', ['+timestamp'])[0]
+        if self._sort[1:] == 'filesize':
+            self._sort_column = 3
+        else:
+            # timestamp
+            self._sort_column = 2
 
     def setup(self):
         self._file_list = []
-        self._pending_directories = [self._mount_point]
-        self._visited_directories = []
-        self._pending_files = []
-        GLib.idle_add(self._scan)
+        self._sort_keys = []
+        self._seen = self._index.start_scan()
+        thread = Thread(target=self._scan)
+        thread.daemon = True
+        thread.start()
 
     def stop(self):
         self._stopped = True
+        # writing the index of a big volume would block the UI
+        thread = Thread(target=self._index.save)
+        thread.start()
 
     def setup_ready(self):
-        if self._sort[1:] == 'filesize':
-            keygetter = itemgetter(3)
-        else:
-            # timestamp
-            keygetter = itemgetter(2)
-        self._file_list.sort(lambda a, b: cmp(b, a),
-                             key=keygetter,
-                             reverse=(self._sort[0] == '-'))
+        self._is_ready = True
         self.ready.send(self)
 
+    def _get_sort_key(self, file_info):
+        # '+' sorts the newest or biggest entries first
+        if self._sort[0] == '-':
+            return file_info[self._sort_column]
+        return -file_info[self._sort_column]
+
+    def _insert_sorted(self, batch):
+        """Merge a batch into the sorted file list
+
+        Returns the positions of the new entries in the updated list, in
+        increasing order.
+        """
+        file_list = []
+        sort_keys = []
+        positions = []
+        start = 0
+        for file_info in sorted(batch, key=self._get_sort_key):
+            key = self._get_sort_key(file_info)
+            end = bisect.bisect_right(self._sort_keys, key, start)
+            file_list.extend(self._file_list[start:end])
+            sort_keys.extend(self._sort_keys[start:end])
+            start = end
+            positions.append(len(file_list))
+            file_list.append(file_info)
+            sort_keys.append(key)
+        file_list.extend(self._file_list[start:])
+        sort_keys.extend(self._sort_keys[start:])
+
+        self._file_list = file_list
+        self._sort_keys = sort_keys
+        return positions
+
     def find(self, query):
         if self._file_list is None:
             raise ValueError('Need to call setup() first')
@@ -314,7 +644,10 @@ class InplaceResultSet(BaseResultSet):
         entries = []
         for file_path, stat, mtime_, size_, metadata in files:
             if metadata is None:
-                metadata = _get_file_metadata(file_path, stat)
+                metadata = _get_file_metadata(file_path, stat,
+                                              fetch_preview=False)
+                self._index.set_file_metadata(file_path, stat, metadata)
+            metadata = metadata.copy()
             metadata['mountpoint'] = self._mount_point
             entries.append(metadata)
 
@@ -334,27 +667,117 @@ class InplaceResultSet(BaseResultSet):
             ids.append(file_path)
         return ids
 
+    def count(self, query):
+        if self._file_list is None:
+            raise ValueError('Need to call setup() first')
+
+        return len(self._file_list)
+
     def _scan(self):
+        """Walk the mount point, runs in a worker thread
+
+        Directories are processed from a queue, and the files found are
+        handed to the main loop in batches every SCAN_BATCH_TIME seconds.
+        The first batch is handed over as soon as it fills a page.
+        """
+        pending_directories = deque([self._mount_point])
+        visited_directories = set()
+        batch = []
+        batch_end = time.time() + SCAN_BATCH_TIME
+        first_batch = True
+
+        while pending_directories:
+            dir_path = pending_directories.popleft()
+            entries = self._scan_directory(dir_path, visited_directories)
+
+            for name, kind in entries:
+                if self._stopped:
+                    return
+                if name.startswith('.'):
+                    continue
+
+                file_info = self._scan_entry(dir_path + '/' + name, kind,
+                                             pending_directories)
+                if file_info is not None:
+                    batch.append(file_info)
+
+                if time.time() > batch_end or \
+                        (first_batch and len(batch) >= self._page_size):
+                    if batch:
+                        GLib.idle_add(self._add_batch, batch, False)
+                        batch = []
+                        first_batch = False
+                    batch_end = time.time() + SCAN_BATCH_TIME
+
         if self._stopped:
-            return False
+            return
+
+        self._index.finish_scan(self._seen)
+        self._index.save()
+        GLib.idle_add(self._add_batch, batch, True)
 
-        self.progress.send(self)
+    def _add_batch(self, batch, finished):
+        if self._stopped:
+            return False
 
-        if self._pending_files:
-            self._scan_a_file()
-            return True
+        positions = self._insert_sorted(batch)
 
-        if self._pending_directories:
-            self._scan_a_directory()
-            return True
+        if positions:
+            # the entries after the first new one have moved
+            self._invalidate_cache(positions[0])
+        self._total_count = len(self._file_list)
 
-        self.setup_ready()
-        self._visited_directories = []
+        if self._is_ready:
+            if positions:
+                self.entries_added.send(self, positions=positions)
+        else:
+            self.progress.send(self)
+            # publish the results as soon as there is a page to show
+            if finished or len(self._file_list) >= self._page_size:
+                self.setup_ready()
         return False
 
-    def _scan_a_file(self):
-        full_path = self._pending_files.pop(0)
-        metadata = None
+    def _scan_directory(self, dir_path, visited_directories):
+        """Return the (name, kind) pairs of the entries of a directory"""
+        try:
+            stat = os.stat(dir_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logging.exception('Error reading directory %r', dir_path)
+            return []
+
+        # links can bring us to the same directory more than once
+        id_tuple = stat.st_ino, stat.st_dev
+        if id_tuple in visited_directories:
+            return []
+        visited_directories.add(id_tuple)
+
+        try:
+            if scandir is not None:
+                entries = [(entry.name, _get_entry_kind(entry))
+                           for entry in scandir(dir_path)]
+            else:
+                entries = [(name, None) for name in os.listdir(dir_path)]
+        except OSError as e:
+            if e.errno != errno.EACCES:
+                logging.exception('Error reading directory %r', dir_path)
+            return []
+
+        return entries
+
+    def _scan_entry(self, full_path, kind, pending_directories):
+        """Return the file_info of an entry, if it matches the query
+
+        kind is the type of the entry as given by the directory listing,
+        or None if unknown. Subdirectories are added to
+        pending_directories.
+        """
+        if kind == _ENTRY_DIRECTORY:
+            pending_directories.append(full_path)
+            return None
+
+        if kind == _ENTRY_OTHER:
+            return None
 
         try:
             stat = os.lstat(full_path)
@@ -362,7 +785,7 @@ class InplaceResultSet(BaseResultSet):
             if e.errno != errno.ENOENT:
                 logging.exception(
                     'Error reading metadata of file %r', full_path)
-            return
+            return None
 
         if S_IFMT(stat.st_mode) == S_IFLNK:
             try:
@@ -370,10 +793,10 @@ class InplaceResultSet(BaseResultSet):
             except OSError as e:
                 logging.exception(
                     'Error reading target of link %r', full_path)
-                return
+                return None
 
             if not os.path.abspath(link).startswith(self._mount_point):
-                return
+                return None
 
             try:
                 stat = os.stat(full_path)
@@ -382,24 +805,26 @@ class InplaceResultSet(BaseResultSet):
                 if e.errno != errno.ENOENT:
                     logging.exception(
                         'Error reading metadata of linked file %r', full_path)
-                return
+                return None
 
         if S_IFMT(stat.st_mode) == S_IFDIR:
-            id_tuple = stat.st_ino, stat.st_dev
-            if id_tuple not in self._visited_directories:
-                self._visited_directories.append(id_tuple)
-                self._pending_directories.append(full_path)
-            return
+            pending_directories.append(full_path)
+            return None
 
         if S_IFMT(stat.st_mode) != S_IFREG:
-            return
+            return None
+
+        return self._filter_file(full_path, stat)
+
+    def _filter_file(self, full_path, stat):
+        metadata = self._index.get_file_metadata(full_path, stat, self._seen)
 
         if self._regex is not None and \
                 not self._regex.match(full_path):
-            metadata = _get_file_metadata(full_path, stat,
-                                          fetch_preview=False)
             if not metadata:
-                return
+                metadata = self._read_metadata(full_path, stat)
+            if not metadata:
+                return None
             add_to_list = False
             for f in ['fulltext', 'title',
                       'description', 'tags']:
@@ -408,61 +833,55 @@ class InplaceResultSet(BaseResultSet):
                     add_to_list = True
                     break
             if not add_to_list:
-                return
+                return None
 
         if self._only_favorites:
             if not metadata:
-                metadata = _get_file_metadata(full_path, stat,
-                                              fetch_preview=False)
+                metadata = self._read_metadata(full_path, stat)
             if 'keep' not in metadata:
-                return
+                return None
             try:
                 if int(metadata['keep']) == 0:
-                    return
+                    return None
             except ValueError:
-                return
+                return None
 
         if self._filter_by_activity:
             if not metadata:
-                metadata = _get_file_metadata(full_path, stat,
-                                              fetch_preview=False)
+                metadata = self._read_metadata(full_path, stat)
             if 'activity' not in metadata or \
                     metadata['activity'] != self._filter_by_activity:
-                return
+                return None
 
         if self._date_start is not None and stat.st_mtime < self._date_start:
-            return
+            return None
 
         if self._date_end is not None and stat.st_mtime > self._date_end:
-            return
+            return None
 
         if self._mime_types:
             mime_type, uncertain_result_ = \
                 Gio.content_type_guess(filename=full_path, data=None)
             if mime_type not in self._mime_types:
-                return
-
-        file_info = (full_path, stat, int(stat.st_mtime), stat.st_size,
-                     metadata)
-        self._file_list.append(file_info)
+                return None
 
-        return
+        return (full_path, stat, int(stat.st_mtime), stat.st_size, metadata)
 
-    def _scan_a_directory(self):
-        dir_path = self._pending_directories.pop(0)
+    def _read_metadata(self, full_path, stat):
+        metadata = _get_file_metadata(full_path, stat, fetch_preview=False)
+        self._index.set_file_metadata(full_path, stat, metadata)
+        return metadata
 
-        try:
-            entries = os.listdir(dir_path)
-        except OSError as e:
-            if e.errno != errno.EACCES:
-                logging.exception('Error reading directory %r', dir_path)
-            return
 
-        for entry in entries:
-            if entry.startswith('.'):
-                continue
-            self._pending_files.append(dir_path + '/' + entry)
-        return
+def _get_entry_kind(entry):
+    """Type of a scandir entry, from d_type when the filesystem has it"""
+    if entry.is_symlink():
+        return _ENTRY_LINK
+    elif entry.is_dir(follow_symlinks=False):
+        return _ENTRY_DIRECTORY
+    elif entry.is_file(follow_symlinks=False):
+        return _ENTRY_FILE
+    return _ENTRY_OTHER
 
 
 def _get_file_metadata(path, stat, fetch_preview=True):
@@ -510,8 +929,7 @@ def _get_file_metadata_from_json(path, fetch_preview):
 
     metadata_path = os.path.join(mount_point, JOURNAL_METADATA_DIR, subdir,
                                  filename + '.metadata')
-    preview_path = os.path.join(mount_point, JOURNAL_METADATA_DIR, subdir,
-                                filename + '.preview')
+    preview_path = _get_preview_path(path)
 
     if not os.path.exists(metadata_path):
         return None
@@ -532,16 +950,41 @@ def _get_file_metadata_from_json(path, fetch_preview):
         if 'preview' in metadata:
             del(metadata['preview'])
     else:
-        if os.path.exists(preview_path):
-            try:
-                metadata['preview'] = dbus.ByteArray(open(preview_path).read())
-            except EnvironmentError:
-                logging.debug('Could not read preview for file %r on '
-                              'external device.', filename)
+        preview = _get_file_preview(path)
+        if preview is not None:
+            metadata['preview'] = preview
 
     return metadata
 
 
+def _get_preview_path(path):
+    filename = os.path.basename(path)
+    dir_path = os.path.dirname(path)
+
+    mount_point = _get_mount_point(path)
+    subdir = ''
+    # check if the file is a subdirectory
+    if mount_point != dir_path:
+        subdir = os.path.relpath(dir_path, mount_point)
+
+    return os.path.join(mount_point, JOURNAL_METADATA_DIR, subdir,
+                        filename + '.preview')
+
+
+def _get_file_preview(path):
+    """Read the preview stored on the external device for a file"""
+    preview_path = _get_preview_path(path)
+    if not os.path.exists(preview_path):
+        return None
+
+    try:
+        return dbus.ByteArray(open(preview_path).read())
+    except EnvironmentError:
+        logging.debug('Could not read preview for file %r on '
+                      'external device.', os.path.basename(path))
+        return None
+
+
 def _get_datastore():
     global _datastore
     if _datastore is None:
@@ -609,6 +1052,102 @@ def get(object_id):
     return metadata
 
 
+class _PreviewCache(object):
+    """LRU cache of previews, bounded by the total size of the previews
+    """
+
+    def __init__(self, max_size):
+        self._previews = OrderedDict()
+        self._size = 0
+        self._max_size = max_size
+
+    def get(self, object_id):
+        preview = self._previews.pop(object_id, None)
+        if preview is not None:
+            self._previews[object_id] = preview
+        return preview
+
+    def add(self, object_id, preview):
+        self.remove(object_id)
+        self._previews[object_id] = preview
+        self._size += len(object_id) + len(preview)
+        while self._size > self._max_size:
+            object_id, preview = self._previews.popitem(last=False)
+            self._size -= len(object_id) + len(preview)
+
+    def remove(self, object_id):
+        preview = self._previews.pop(object_id, None)
+        if preview is not None:
+            self._size -= len(object_id) + len(preview)
+
+
+_preview_cache = _PreviewCache(PREVIEW_CACHE_SIZE)
+_pending_previews = {}
+
+
+def get_preview(object_id, ready_callback=None):
+    """Returns the preview of an object if it is already loaded
+
+    Otherwise None is returned, the preview is loaded asynchronously and
+    ready_callback is called with the object id and the preview once it
+    is available. Objects without a preview have an empty preview.
+    """
+    preview = _preview_cache.get(object_id)
+    if preview is not None:
+        return preview
+
+    callbacks = _pending_previews.get(object_id)
+    if callbacks is None:
+        callbacks = _pending_previews[object_id] = []
+        _load_preview(object_id)
+    if ready_callback is not None:
+        callbacks.append(ready_callback)
+    return None
+
+
+def _load_preview(object_id):
+    def reply_handler(metadata):
+        _preview_loaded(object_id, metadata.get('preview', ''))
+
+    def error_handler(error):
+        logging.error('Could not load the preview of %r: %s', object_id,
+                      error)
+        # don't ask again on every redraw, until the object changes
+        _preview_loaded(object_id, '')
+
+    def load_file_preview_cb():
+        preview = _get_file_preview(object_id)
+        _preview_loaded(object_id, preview or '')
+        return False
+
+    if os.path.exists(object_id):
+        GLib.idle_add(load_file_preview_cb)
+    else:
+        _get_datastore().get_properties(object_id, byte_arrays=True,
+                                        reply_handler=reply_handler,
+                                        error_handler=error_handler)
+
+
+def _preview_loaded(object_id, preview):
+    callbacks = _pending_previews.pop(object_id, None)
+    if callbacks is None:
+        # the object changed while the preview was loading
+        return
+
+    _preview_cache.add(object_id, preview)
+    for callback in callbacks:
+        callback(object_id, preview)
+
+
+def _object_changed_cb(sender, signal, object_id):
+    _preview_cache.remove(object_id)
+    _pending_previews.pop(object_id, None)
+
+
+updated.connect(_object_changed_cb)
+deleted.connect(_object_changed_cb)
+
+
 def get_file(object_id):
     """Returns the file for an object
     """
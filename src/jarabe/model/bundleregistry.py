@@ -15,7 +15,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import logging
+import tempfile
+import multiprocessing
 from threading import Thread, Lock
 
 from gi.repository import GObject
@@ -26,11 +29,13 @@ import json
 
 from sugar3.bundle.helpers import bundle_from_dir
 from sugar3.bundle.activitybundle import ActivityBundle
+from sugar3.bundle.contentbundle import ContentBundle
 from sugar3.bundle.bundleversion import NormalizedVersion
 from sugar3.bundle.bundle import MalformedBundleException, \
     AlreadyInstalledException, RegistrationException
 from sugar3 import env
 
+from jarabe import config
 from jarabe.model import desktop
 from jarabe.model import mimeregistry
 
@@ -55,7 +60,16 @@ immediately by the shell.
 """
 
 _DEFAULT_VIEW = 0
+_BUNDLE_CACHE_VERSION = 2
+# Bundle classes whose parsed fields can be stored in the bundle cache
+_CACHED_BUNDLE_CLASSES = {
+    'ActivityBundle': ActivityBundle,
+    'ContentBundle': ContentBundle,
+}
+_FAVORITES_WRITE_DELAY = 500
+
 _instance = None
+_mime_database_lock = Lock()
 
 
 class BundleRegistry(GObject.GObject):
@@ -84,6 +98,13 @@ class BundleRegistry(GObject.GObject):
         self._lock = Lock()
         self._bundles = []
 
+        # Indexes of _bundles, only modified together with it
+        self._bundles_by_id = {}
+        self._bundles_by_version = {}
+        self._bundles_by_path = {}
+        # mime type -> activity bundles that open it, in _bundles order
+        self._bundles_by_mime_type = {}
+
         # hold a reference to the monitors so they don't get disposed
         self._gio_monitors = []
 
@@ -92,15 +113,30 @@ class BundleRegistry(GObject.GObject):
         for data_dir in GLib.get_system_data_dirs():
             dirs.append(os.path.join(data_dir, "sugar", "activities"))
 
+        # The bundles parsed in a previous session, so we only parse the
+        # ones that changed since
+        self._bundle_cache = self._load_bundle_cache()
+        self._bundle_cache_dirty = False
+        new_bundle_cache = {}
+
         for activity_dir in dirs:
-            self._scan_directory(activity_dir)
+            self._scan_directory(activity_dir, new_bundle_cache)
             directory = Gio.File.new_for_path(activity_dir)
             monitor = directory.monitor_directory(
                 flags=Gio.FileMonitorFlags.NONE, cancellable=None)
             monitor.connect('changed', self.__file_monitor_changed_cb)
             self._gio_monitors.append(monitor)
 
+        if self._bundle_cache_dirty or \
+                len(new_bundle_cache) != len(self._bundle_cache):
+            self._write_bundle_cache(new_bundle_cache)
+        self._bundle_cache = None
+
         self._favorite_bundles = []
+        # favorite view -> contents of its file as last loaded or written
+        self._favorites_data = {}
+        self._dirty_favorite_views = set()
+        self._favorites_write_sid = None
         for i in range(desktop.get_number_of_views()):
             self._favorite_bundles.append({})
 
@@ -181,14 +217,19 @@ class BundleRegistry(GObject.GObject):
             raise ValueError('bundle_id cannot contain spaces')
         return '%s %s' % (bundle_id, version)
 
+    def _get_favorites_path(self, favorite_view):
+        # Special-case 0 for backward compatibility
+        if favorite_view == 0:
+            return env.get_profile_path('favorite_activities')
+        else:
+            return env.get_profile_path('favorite_activities_%d' %
+                                        (favorite_view))
+
     def _load_favorites(self):
+        # don't let the files overwrite changes that are still queued
+        self.flush_favorites()
         for i in range(desktop.get_number_of_views()):
-            # Special-case 0 for backward compatibility
-            if i == 0:
-                favorites_path = env.get_profile_path('favorite_activities')
-            else:
-                favorites_path = env.get_profile_path(
-                    'favorite_activities_%d' % (i))
+            favorites_path = self._get_favorites_path(i)
             if os.path.exists(favorites_path):
                 favorites_data = json.load(open(favorites_path))
 
@@ -208,6 +249,8 @@ class BundleRegistry(GObject.GObject):
                                          favorites_path)
 
                 self._favorite_bundles[i] = favorite_bundles
+                self._favorites_data[i] = \
+                    self._dump_favorites(favorite_bundles)
 
     def _load_hidden_activities(self):
         path = os.environ.get('SUGAR_ACTIVITIES_HIDDEN', None)
@@ -229,7 +272,7 @@ class BundleRegistry(GObject.GObject):
                 if 'favorite' not in data:
                     data['favorite'] = True
                 self._favorite_bundles[i][key] = data
-            self._write_favorites_file(i)
+            self._queue_favorites_write(i)
 
     def _scan_new_favorites(self):
         for bundle in self:
@@ -239,15 +282,55 @@ class BundleRegistry(GObject.GObject):
             if key not in self._favorite_bundles[_DEFAULT_VIEW]:
                 self._favorite_bundles[_DEFAULT_VIEW][key] = \
                     {'favorite': bundle_id not in self._hidden_activities}
-        self._write_favorites_file(_DEFAULT_VIEW)
+        self._queue_favorites_write(_DEFAULT_VIEW)
 
     def get_bundle(self, bundle_id):
         """Returns an bundle given his service name"""
         with self._lock:
-            for bundle in self._bundles:
-                if bundle.get_bundle_id() == bundle_id:
-                    return bundle
-        return None
+            return self._bundles_by_id.get(bundle_id)
+
+    def _index_bundle(self, bundle):
+        # Must be called with the lock held
+        bundle_id = bundle.get_bundle_id()
+        version = bundle.get_activity_version()
+        self._bundles_by_id.setdefault(bundle_id, bundle)
+        self._bundles_by_version.setdefault((bundle_id, version), bundle)
+        self._bundles_by_path.setdefault(bundle.get_path(), bundle)
+
+    def _index_mime_types(self, bundle):
+        # Must be called with the lock held
+        if not isinstance(bundle, ActivityBundle):
+            return
+        for mime_type in set(bundle.get_mime_types() or []):
+            self._bundles_by_mime_type.setdefault(mime_type, []).append(bundle)
+
+    def _unindex_mime_types(self, bundle):
+        # Must be called with the lock held
+        if not isinstance(bundle, ActivityBundle):
+            return
+        for mime_type in set(bundle.get_mime_types() or []):
+            bundles = self._bundles_by_mime_type.get(mime_type, [])
+            if bundle in bundles:
+                bundles.remove(bundle)
+            if not bundles:
+                self._bundles_by_mime_type.pop(mime_type, None)
+
+    def _unindex_bundle(self, bundle):
+        # Must be called with the lock held, after removing the bundle
+        # from _bundles. Another bundle may take its place in the indexes.
+        bundle_id = bundle.get_bundle_id()
+        version = bundle.get_activity_version()
+        path = bundle.get_path()
+        for index, key in ((self._bundles_by_id, bundle_id),
+                           (self._bundles_by_version, (bundle_id, version)),
+                           (self._bundles_by_path, path)):
+            if index.get(key) is bundle:
+                del index[key]
+
+        for other in self._bundles:
+            if other.get_bundle_id() == bundle_id or \
+                    other.get_path() == path:
+                self._index_bundle(other)
 
     def __iter__(self):
         with self._lock:
@@ -258,40 +341,145 @@ class BundleRegistry(GObject.GObject):
         with self._lock:
             return len(self._bundles)
 
-    def _scan_directory(self, path):
+    def _get_bundle_cache_path(self):
+        return env.get_profile_path('bundle_registry_cache.json')
+
+    def _get_bundle_cache_key(self):
+        # Translated names depend on the language of the session, and the
+        # fields of the bundles on the toolkit that parsed them
+        return [_BUNDLE_CACHE_VERSION, config.version,
+                os.environ.get('LANGUAGE'), os.environ.get('LANG'),
+                _get_toolkit_stamp()]
+
+    def _load_bundle_cache(self):
+        path = self._get_bundle_cache_path()
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path) as cache_file:
+                data = json.load(cache_file)
+        except (ValueError, EnvironmentError):
+            logging.exception('Error while loading %s', path)
+            return {}
+
+        if data.get('key') != self._get_bundle_cache_key():
+            return {}
+
+        bundle_cache = {}
+        for folder, (state, bundle_data) in data['bundles'].iteritems():
+            bundle = _bundle_from_json(bundle_data)
+            if bundle is not None:
+                bundle_cache[folder.encode('utf-8')] = (state, bundle)
+        return bundle_cache
+
+    def _write_bundle_cache(self, bundles):
+        path = self._get_bundle_cache_path()
+        cached_bundles = {}
+        for folder, (state, bundle) in bundles.iteritems():
+            bundle_data = _bundle_to_json(bundle)
+            if bundle_data is not None:
+                cached_bundles[folder] = [state, bundle_data]
+
+        data = {'key': self._get_bundle_cache_key(),
+                'bundles': cached_bundles}
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.rename(temp_path, path)
+        except (ValueError, EnvironmentError):
+            logging.exception('Error while writing %s', path)
+
+    def _get_bundle_dir_state(self, bundle_dir, stat):
+        """Values that change when the bundle in a directory changes"""
+        info_mtime = None
+        for info_path in ('activity/activity.info', 'library/library.info'):
+            try:
+                info_mtime = os.stat(os.path.join(bundle_dir,
+                                                  info_path)).st_mtime
+            except OSError:
+                continue
+            break
+
+        # the translations of the activity info
+        linfo_mtimes = []
+        locale_dir = os.path.join(bundle_dir, 'locale')
+        try:
+            languages = sorted(os.listdir(locale_dir))
+        except OSError:
+            languages = []
+        for language in languages:
+            try:
+                linfo_mtimes.append([language, os.stat(os.path.join(
+                    locale_dir, language, 'activity.linfo')).st_mtime])
+            except OSError:
+                continue
+
+        return [stat.st_ino, stat.st_mtime, info_mtime, linfo_mtimes]
+
+    def _scan_directory(self, path, bundle_cache):
         if not os.path.isdir(path):
             return
 
         # Sort by mtime to ensure a stable activity order
         bundles = {}
+        states = {}
         for f in os.listdir(path):
             try:
                 bundle_dir = os.path.join(path, f)
                 if os.path.isdir(bundle_dir):
-                    bundles[bundle_dir] = os.stat(bundle_dir).st_mtime
+                    stat = os.stat(bundle_dir)
+                    bundles[bundle_dir] = stat.st_mtime
+                    states[bundle_dir] = \
+                        self._get_bundle_dir_state(bundle_dir, stat)
             except Exception:
                 logging.exception('Error while processing installed activity'
                                   ' bundle %s:', bundle_dir)
 
         bundle_dirs = bundles.keys()
         bundle_dirs.sort(lambda d1, d2: cmp(bundles[d1], bundles[d2]))
+
+        parsed_bundles = {}
+        to_parse = []
+        for folder in bundle_dirs:
+            cached = self._bundle_cache.get(folder)
+            if cached is not None and cached[0] == states[folder]:
+                parsed_bundles[folder] = cached[1]
+            else:
+                to_parse.append(folder)
+        if to_parse:
+            parsed_bundles.update(self._parse_bundles(to_parse))
+            self._bundle_cache_dirty = True
+
+        # Register in mtime order, whatever order the parsing finished in
         for folder in bundle_dirs:
             try:
-                self.add_bundle(folder, emit_signals=False)
+                bundle = parsed_bundles.get(folder)
+                if bundle is not None:
+                    bundle_cache[folder] = (states[folder], bundle)
+                    self._add_bundle(bundle, emit_signals=False)
             except:
                 # pylint: disable=W0702
                 logging.exception('Error while processing installed activity'
                                   ' bundle %s:', folder)
 
-    def add_bundle(self, bundle_path, set_favorite=False, emit_signals=True,
-                   force_downgrade=False):
-        """
-        Add a bundle to the registry.
-        If the bundle is a duplicate with one already in the registry,
-        the existing one from the registry is returned.
-        Otherwise, the newly added bundle is returned on success, or None on
-        failure.
+    def _parse_bundles(self, bundle_paths):
+        """Returns a dictionary from path to bundle, or to None if the bundle
+        could not be loaded.
         """
+        return dict((bundle_path, self._parse_bundle(bundle_path))
+                    for bundle_path in bundle_paths)
+
+    def _parse_bundle(self, bundle_path):
+        try:
+            return self._load_bundle(bundle_path)
+        except Exception:
+            logging.exception('Error while processing installed activity'
+                              ' bundle %s:', bundle_path)
+            return None
+
+    def _load_bundle(self, bundle_path):
         try:
             bundle = bundle_from_dir(bundle_path)
         except MalformedBundleException:
@@ -303,6 +491,26 @@ class BundleRegistry(GObject.GObject):
             logging.error('No bundle in %r', bundle_path)
             return None
 
+        return bundle
+
+    def add_bundle(self, bundle_path, set_favorite=False, emit_signals=True,
+                   force_downgrade=False):
+        """
+        Add a bundle to the registry.
+        If the bundle is a duplicate with one already in the registry,
+        the existing one from the registry is returned.
+        Otherwise, the newly added bundle is returned on success, or None on
+        failure.
+        """
+        bundle = self._load_bundle(bundle_path)
+        if bundle is None:
+            return None
+
+        return self._add_bundle(bundle, set_favorite, emit_signals,
+                                force_downgrade)
+
+    def _add_bundle(self, bundle, set_favorite=False, emit_signals=True,
+                    force_downgrade=False):
         bundle_id = bundle.get_bundle_id()
         logging.debug('STARTUP: Adding bundle %s', bundle_id)
         installed = self.get_bundle(bundle_id)
@@ -330,19 +538,19 @@ class BundleRegistry(GObject.GObject):
 
         with self._lock:
             self._bundles.append(bundle)
+            self._index_bundle(bundle)
+            self._index_mime_types(bundle)
         if emit_signals:
             self.emit('bundle-added', bundle)
         return bundle
 
     def remove_bundle(self, bundle_path, emit_signals=True):
-        removed = None
-        self._lock.acquire()
-        for bundle in self._bundles:
-            if bundle.get_path() == bundle_path:
-                self._bundles.remove(bundle)
-                removed = bundle
-                break
-        self._lock.release()
+        with self._lock:
+            removed = self._bundles_by_path.get(bundle_path)
+            if removed is not None:
+                self._bundles.remove(removed)
+                self._unindex_bundle(removed)
+                self._unindex_mime_types(removed)
 
         if emit_signals and removed is not None:
             self.emit('bundle-removed', removed)
@@ -355,17 +563,17 @@ class BundleRegistry(GObject.GObject):
         default_bundle_id = mime.get_default_activity(mime_type)
         default_bundle = None
 
-        for bundle in self:
-            if not isinstance(bundle, ActivityBundle):
-                continue
-            if mime_type in (bundle.get_mime_types() or []):
-                if bundle.get_bundle_id() == default_bundle_id:
-                    default_bundle = bundle
-                elif self.get_default_for_type(mime_type) == \
-                        bundle.get_bundle_id():
-                    result.insert(0, bundle)
-                else:
-                    result.append(bundle)
+        with self._lock:
+            bundles = list(self._bundles_by_mime_type.get(mime_type, []))
+
+        for bundle in bundles:
+            if bundle.get_bundle_id() == default_bundle_id:
+                default_bundle = bundle
+            elif self.get_default_for_type(mime_type) == \
+                    bundle.get_bundle_id():
+                result.insert(0, bundle)
+            else:
+                result.append(bundle)
 
         if default_bundle is not None:
             result.insert(0, default_bundle)
@@ -377,10 +585,9 @@ class BundleRegistry(GObject.GObject):
 
     def _find_bundle(self, bundle_id, version):
         with self._lock:
-            for bundle in self._bundles:
-                if bundle.get_bundle_id() == bundle_id and \
-                        bundle.get_activity_version() == version:
-                    return bundle
+            bundle = self._bundles_by_version.get((bundle_id, version))
+        if bundle is not None:
+            return bundle
         raise ValueError('No bundle %r with version %r exists.' %
                          (bundle_id, version))
 
@@ -401,7 +608,7 @@ class BundleRegistry(GObject.GObject):
                 self._favorite_bundles[favorite_view][key]['favorite']:
             return False
         self._favorite_bundles[favorite_view][key]['favorite'] = favorite
-        self._write_favorites_file(favorite_view)
+        self._queue_favorites_write(favorite_view)
         return True
 
     def is_bundle_favorite(self, bundle_id, version, favorite_view=0):
@@ -434,7 +641,7 @@ class BundleRegistry(GObject.GObject):
         else:
             return
 
-        self._write_favorites_file(favorite_view)
+        self._queue_favorites_write(favorite_view)
         bundle = self._find_bundle(bundle_id, version)
         self.emit('bundle-changed', bundle)
 
@@ -450,23 +657,55 @@ class BundleRegistry(GObject.GObject):
             return \
                 tuple(self._favorite_bundles[favorite_view][key]['position'])
 
+    def _dump_favorites(self, favorite_bundles):
+        return json.dumps({'favorites': favorite_bundles}, sort_keys=True)
+
+    def _queue_favorites_write(self, favorite_view):
+        """Write the favorites of a view to disk after a short delay, so
+        that bursts of changes (eg. dragging icons) end in a single write.
+        """
+        self._dirty_favorite_views.add(favorite_view)
+        if self._favorites_write_sid is None:
+            self._favorites_write_sid = GLib.timeout_add(
+                _FAVORITES_WRITE_DELAY, self.__write_favorites_timeout_cb)
+
+    def __write_favorites_timeout_cb(self):
+        self._favorites_write_sid = None
+        self.flush_favorites()
+        return False
+
+    def flush_favorites(self):
+        """Write any pending favorites changes to disk now"""
+        if self._favorites_write_sid is not None:
+            GLib.source_remove(self._favorites_write_sid)
+            self._favorites_write_sid = None
+
+        dirty_views = self._dirty_favorite_views
+        self._dirty_favorite_views = set()
+        for favorite_view in sorted(dirty_views):
+            self._write_favorites_file(favorite_view)
+
     def _write_favorites_file(self, favorite_view):
-        if favorite_view == 0:
-            path = env.get_profile_path('favorite_activities')
-        else:
-            path = env.get_profile_path('favorite_activities_%d' %
-                                        (favorite_view))
-        favorites_data = {
-            'favorites': self._favorite_bundles[favorite_view]}
-        json.dump(favorites_data, open(path, 'w'), indent=1)
+        data = self._dump_favorites(self._favorite_bundles[favorite_view])
+        if data == self._favorites_data.get(favorite_view):
+            return
+
+        path = self._get_favorites_path(favorite_view)
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as favorites_file:
+                favorites_file.write(data)
+            os.rename(temp_path, path)
+        except Exception:
+            logging.exception('Error while writing %s', path)
+            return
+        self._favorites_data[favorite_view] = data
 
     def is_installed(self, bundle):
-        for installed_bundle in self:
-            if bundle.get_bundle_id() == installed_bundle.get_bundle_id() and \
-                    NormalizedVersion(bundle.get_activity_version()) == \
-                    NormalizedVersion(installed_bundle.get_activity_version()):
-                return True
-        return False
+        installed_bundle = self.get_bundle(bundle.get_bundle_id())
+        return installed_bundle is not None and \
+            NormalizedVersion(bundle.get_activity_version()) == \
+            NormalizedVersion(installed_bundle.get_activity_version())
 
     def install(self, bundle, force_downgrade=False):
         """
@@ -616,47 +855,73 @@ class _InstallQueue(object):
     A class to represent a queue of bundles to be installed, and to handle
     execution of each task in the queue. Only for internal bundleregistry use.
 
-    The use of a queue means that we serialize all bundle upgrade processing.
-    This is necessary to avoid many difficult corner-cases like: what happens
-    if two users try to asynchronously and simultaenously install different
-    version of the same bundle?
-
-    We maintain at maximum one thread to do the actual bundle install. When
-    done, the thread enqueues a callback in the main thread (via the GLib
-    main loop).
+    Tasks are run in the order they were queued by a bounded pool of worker
+    threads. Installs of the same bundle are serialized, so we avoid many
+    difficult corner-cases like: what happens if two users try to
+    asynchronously and simultaenously install different version of the same
+    bundle? A bundle id is only released once the completion callback of its
+    task has run in the main thread (via the GLib main loop), so the next
+    install of that bundle sees the registry updated.
     """
 
     def __init__(self, registry):
         self._lock = Lock()
         self._queue = []
-        self._thread_running = False
+        self._active_bundle_ids = set()
+        self._workers = 0
+        self._max_workers = _get_cpu_count()
         self._registry = registry
 
     def enqueue(self, bundle, force_downgrade, callback, user_data):
-        task = _InstallTask(bundle, force_downgrade, callback, user_data)
-        self._lock.acquire()
-        self._queue.append(task)
-        if not self._thread_running:
-            self._thread_running = True
-            Thread(target=self._thread_func).start()
-        self._lock.release()
+        task = _InstallTask(self, bundle, force_downgrade, callback,
+                            user_data)
+        with self._lock:
+            self._queue.append(task)
+        self._start_workers()
+
+    def _start_workers(self):
+        with self._lock:
+            runnable = len([task for task in self._queue
+                            if task.bundle_id not in self._active_bundle_ids])
+            while self._workers < min(runnable, self._max_workers):
+                self._workers += 1
+                # not a daemon, quitting must not interrupt an install
+                Thread(target=self._thread_func).start()
+
+    def _next_task(self):
+        # Must be called with the lock held
+        for task in self._queue:
+            if task.bundle_id is None or \
+                    task.bundle_id not in self._active_bundle_ids:
+                self._queue.remove(task)
+                if task.bundle_id is not None:
+                    self._active_bundle_ids.add(task.bundle_id)
+                return task
+        return None
 
     def _thread_func(self):
         while True:
-            self._lock.acquire()
-            if len(self._queue) == 0:
-                self._thread_running = False
-                self._lock.release()
-                return
-
-            task = self._queue.pop()
-            self._lock.release()
+            with self._lock:
+                task = self._next_task()
+                if task is None:
+                    self._workers -= 1
+                    return
 
             self._do_work(task)
 
+    def task_done(self, task, result):
+        """Called in main loop context when a task has finished"""
+        try:
+            task.callback(task.bundle, result, task.user_data)
+        finally:
+            with self._lock:
+                self._active_bundle_ids.discard(task.bundle_id)
+            self._start_workers()
+        return False
+
     def _do_work(self, task):
         bundle = task.bundle
-        bundle_id = bundle.get_bundle_id()
+        bundle_id = task.bundle_id
         act = self._registry.get_bundle(bundle_id)
         logging.debug("InstallQueue task %s installed %r", bundle_id, act)
 
@@ -678,7 +943,9 @@ class _InstallQueue(object):
             # Uninstall the previous version, if we can
             if act.is_user_activity():
                 try:
-                    act.uninstall()
+                    # uninstalling updates the shared mime database
+                    with _mime_database_lock:
+                        act.uninstall()
                 except:
                     logging.exception('Uninstall failed, still trying to '
                                       'install newer bundle')
@@ -688,7 +955,7 @@ class _InstallQueue(object):
                                 'activities')
 
         try:
-            task.queue_callback(bundle.install())
+            task.queue_callback(_install_bundle(bundle))
         except Exception as e:
             logging.debug("InstallThread install failed: %r", e)
             task.queue_callback(e)
@@ -700,14 +967,90 @@ class _InstallTask(object):
     Only for use internal to InstallQueue.
     """
 
-    def __init__(self, bundle, force_downgrade, callback, user_data):
+    def __init__(self, queue, bundle, force_downgrade, callback, user_data):
+        self.queue = queue
         self.bundle = bundle
+        self.bundle_id = bundle.get_bundle_id()
         self.callback = callback
         self.force_downgrade = force_downgrade
         self.user_data = user_data
 
     def queue_callback(self, result):
-        GLib.idle_add(self.callback, self.bundle, result, self.user_data)
+        GLib.idle_add(self.queue.task_done, self, result)
+
+
+def _install_bundle(bundle):
+    """Install a bundle, from an install thread
+
+    Bundles are unpacked in parallel, but registering their mime types
+    creates the shared mime and icon directories and runs
+    update-mime-database on them, so that step is done one at a time.
+    """
+    install_mime_type = getattr(bundle, 'install_mime_type', None)
+    if install_mime_type is None:
+        return bundle.install()
+
+    def locked_install_mime_type(*args, **kwargs):
+        with _mime_database_lock:
+            return install_mime_type(*args, **kwargs)
+
+    bundle.install_mime_type = locked_install_mime_type
+    try:
+        return bundle.install()
+    finally:
+        del bundle.install_mime_type
+
+
+def _get_toolkit_stamp():
+    # changes when the toolkit is upgraded
+    module_path = sys.modules[ActivityBundle.__module__].__file__
+    try:
+        return [module_path, os.stat(module_path).st_mtime]
+    except OSError:
+        return None
+
+
+def _decode_strings(value):
+    # JSON gives back unicode, but the bundles are parsed into byte strings
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_decode_strings(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((_decode_strings(key), _decode_strings(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def _bundle_to_json(bundle):
+    """The parsed fields of a bundle, None if they can't be stored"""
+    class_name = bundle.__class__.__name__
+    if _CACHED_BUNDLE_CLASSES.get(class_name) is not bundle.__class__:
+        return None
+
+    fields = vars(bundle)
+    try:
+        json.dumps(fields)
+    except (TypeError, ValueError):
+        return None
+    return {'class': class_name, 'fields': fields}
+
+
+def _bundle_from_json(bundle_data):
+    bundle_class = _CACHED_BUNDLE_CLASSES.get(bundle_data.get('class'))
+    if bundle_class is None:
+        return None
+    # the fields are already parsed, don't call __init__
+    bundle = bundle_class.__new__(bundle_class)
+    bundle.__dict__.update(_decode_strings(bundle_data['fields']))
+    return bundle
+
+
+def _get_cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
 
 
 def get_registry():
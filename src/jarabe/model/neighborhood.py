@@ -710,6 +710,11 @@ class Neighborhood(GObject.GObject):
 
         self._buddies = {None: get_owner_instance()}
         self._activities = {}
+        # secondary indexes, kept in sync with the dicts above
+        self._buddies_by_key = {}
+        self._buddies_by_handle = {}
+        self._activities_by_room = {}
+        self._index_buddy_key(self._buddies[None])
         self._link_local_account = None
         self._server_account = None
         self._shell_model = shell.get_model()
@@ -922,6 +927,8 @@ class Neighborhood(GObject.GObject):
             contact_id=contact_id,
             handle=handle)
         self._buddies[contact_id] = buddy
+        self._buddies_by_handle.setdefault(handle, {})[account.object_path] = \
+            buddy
 
     def __buddy_updated_cb(self, account, contact_id, properties):
         logging.debug('__buddy_updated_cb %r', contact_id)
@@ -942,8 +949,10 @@ class Neighborhood(GObject.GObject):
             # arrives unicode but we connect with byte_arrays=True - SL #4157
             buddy.props.color = XoColor(str(properties['color']))
 
-        if 'key' in properties:
+        if 'key' in properties and properties['key'] != buddy.props.key:
+            self._unindex_buddy_key(buddy)
             buddy.props.key = properties['key']
+            self._index_buddy_key(buddy)
 
         nick_key = CONNECTION_INTERFACE_ALIASING + '/alias'
         if nick_key in properties:
@@ -961,6 +970,12 @@ class Neighborhood(GObject.GObject):
 
         buddy = self._buddies[contact_id]
         del self._buddies[contact_id]
+        self._unindex_buddy_key(buddy)
+        buddies = self._buddies_by_handle.get(buddy.props.handle, {})
+        if buddies.get(buddy.props.account) is buddy:
+            del buddies[buddy.props.account]
+            if not buddies:
+                del self._buddies_by_handle[buddy.props.handle]
 
         if buddy.props.key is not None:
             self.emit('buddy-removed', buddy)
@@ -973,6 +988,7 @@ class Neighborhood(GObject.GObject):
 
         activity = ActivityModel(activity_id, room_handle)
         self._activities[activity_id] = activity
+        self._activities_by_room.setdefault(room_handle, []).append(activity)
 
     def __activity_updated_cb(self, account, activity_id, properties):
         logging.debug('__activity_updated_cb %r %r', activity_id, properties)
@@ -1010,6 +1026,10 @@ class Neighborhood(GObject.GObject):
             return
         activity = self._activities[activity_id]
         del self._activities[activity_id]
+        activities = self._activities_by_room[activity.room_handle]
+        activities.remove(activity)
+        if not activities:
+            del self._activities_by_room[activity.room_handle]
         self._shell_model.remove_shared_activity(activity_id)
 
         if activity.props.bundle is not None:
@@ -1069,25 +1089,42 @@ class Neighborhood(GObject.GObject):
     def get_buddies(self):
         return self._buddies.values()
 
+    def _index_buddy_key(self, buddy):
+        if buddy.props.key is not None:
+            self._buddies_by_key.setdefault(buddy.props.key, []).append(buddy)
+
+    def _unindex_buddy_key(self, buddy):
+        buddies = self._buddies_by_key.get(buddy.props.key)
+        if buddies is not None and buddy in buddies:
+            buddies.remove(buddy)
+            if not buddies:
+                del self._buddies_by_key[buddy.props.key]
+
     def get_buddy_by_key(self, key):
-        for buddy in self._buddies.values():
-            if buddy.key == key:
-                return buddy
+        buddies = self._buddies_by_key.get(key)
+        if buddies:
+            return buddies[0]
         return None
 
-    def get_buddy_by_handle(self, contact_handle):
-        for buddy in self._buddies.values():
-            if not buddy.is_owner() and buddy.handle == contact_handle:
-                return buddy
-        return None
+    def get_buddy_by_handle(self, contact_handle, account=None):
+        """
+        Handles are only unique within an account, when no account path is
+        given the buddy of any account with that handle is returned.
+        """
+        buddies = self._buddies_by_handle.get(contact_handle)
+        if not buddies:
+            return None
+        if account is not None:
+            return buddies.get(account)
+        return buddies.values()[0]
 
     def get_activity(self, activity_id):
         return self._activities.get(activity_id, None)
 
     def get_activity_by_room(self, room_handle):
-        for activity in self._activities.values():
-            if activity.room_handle == room_handle:
-                return activity
+        activities = self._activities_by_room.get(room_handle)
+        if activities:
+            return activities[0]
         return None
 
     def get_activities(self):
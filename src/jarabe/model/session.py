@@ -21,6 +21,7 @@ import os
 import logging
 
 from jarabe.model import shell
+from jarabe.model import bundleregistry
 
 
 _session_manager = None
@@ -60,6 +61,7 @@ class SessionManager(GObject.GObject):
 
     def initiate_shutdown(self, logout_mode):
         self._logout_mode = logout_mode
+        bundleregistry.get_registry().flush_favorites()
         self.shutdown_signal.emit()
         self.session.initiate_shutdown()
 
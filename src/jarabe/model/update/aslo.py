@@ -60,6 +60,7 @@ from sugar3.bundle.bundleversion import InvalidVersionError
 from jarabe import config
 from jarabe.model.update import BundleUpdate
 from jarabe.util.downloader import Downloader
+from jarabe.util.downloader import get_soup_session
 
 _FIND_DESCRIPTION = \
     './/{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description'
@@ -69,6 +70,9 @@ _FIND_SIZE = './/{http://www.mozilla.org/2004/em-rdf#}updateSize'
 
 _UPDATE_PATH = 'http://activities.sugarlabs.org/services/update-aslo.php'
 
+_MAX_PARALLEL_CHECKS = 8
+_CHECK_TIMEOUT = 30
+
 _logger = logging.getLogger('ASLO')
 
 
@@ -78,11 +82,18 @@ class _UpdateChecker(GObject.GObject):
     }
     _CHUNK_SIZE = 10240
 
-    def __init__(self):
+    def __init__(self, session=None):
         GObject.GObject.__init__(self)
         self._bundle = None
+        self._session = session
+        self._downloader = None
+        self._timeout_sid = None
+        self._timed_out = False
+
+    def get_bundle(self):
+        return self._bundle
 
-    def check(self, bundle):
+    def check(self, bundle, timeout=_CHECK_TIMEOUT):
         # ASLO knows only about stable SP releases
         major, minor = config.version.split('.')[0:2]
         sp_version = '%s.%s' % (major, int(minor) + int(minor) % 2)
@@ -93,17 +104,41 @@ class _UpdateChecker(GObject.GObject):
         self._bundle = bundle
 
         _logger.debug('Fetch %s', url)
-        self._downloader = Downloader(url)
+        self._downloader = Downloader(url, self._session)
         self._downloader.connect('complete', self.__downloader_complete_cb)
         self._downloader.download()
+        self._timeout_sid = GLib.timeout_add_seconds(timeout,
+                                                     self.__timeout_cb)
+
+    def cancel(self):
+        if self._downloader is not None:
+            self._downloader.cancel()
+
+    def __timeout_cb(self):
+        self._timeout_sid = None
+        self._timed_out = True
+        self.cancel()
+        return False
 
     def __downloader_complete_cb(self, downloader, result):
+        self._downloader = None
+        if self._timeout_sid is not None:
+            GLib.source_remove(self._timeout_sid)
+            self._timeout_sid = None
+
+        if self._timed_out:
+            self.emit('check-complete',
+                      IOError('Timed out checking %s' %
+                              self._bundle.get_bundle_id()))
+            return
+
         if isinstance(result, Exception):
             self.emit('check-complete', result)
             return
 
         if result is None:
             _logger.error('No XML update data returned from ASLO')
+            self.emit('check-complete', None)
             return
 
         document = XML(result.get_data())
@@ -146,40 +181,74 @@ class _UpdateChecker(GObject.GObject):
 class AsloUpdater(object):
     """
     Track state while querying Activites.SugarLabs.Org for activity updates.
+
+    Up to max_parallel_checks bundles are checked at the same time over the
+    shared Soup session, each request giving up after check_timeout seconds.
     """
 
-    def __init__(self):
+    def __init__(self, max_parallel_checks=_MAX_PARALLEL_CHECKS,
+                 check_timeout=_CHECK_TIMEOUT):
         self._completion_cb = None
         self._progress_cb = None
         self._cancelling = False
         self._updates = []
-        self._checker = _UpdateChecker()
-        self._checker.connect('check-complete', self._check_complete_cb)
+        self._bundles_to_check = []
+        self._total_bundles_to_check = 0
+        self._checked = 0
+        self._checkers = []
+        self._check_sid = None
+        self._max_parallel_checks = max_parallel_checks
+        self._check_timeout = check_timeout
+
+        self._session = get_soup_session()
+        # Soup would otherwise queue the requests to the server two at a time
+        if self._session.props.max_conns_per_host < max_parallel_checks:
+            self._session.props.max_conns_per_host = max_parallel_checks
+        if self._session.props.max_conns < max_parallel_checks:
+            self._session.props.max_conns = max_parallel_checks
 
     def _check_complete_cb(self, checker, result):
+        self._checkers.remove(checker)
+        self._checked += 1
+
+        bundle = checker.get_bundle()
         if isinstance(result, Exception):
-            logging.warning("Failed to check bundle: %r", result)
+            logging.warning("Failed to check bundle %s: %r",
+                            bundle.get_bundle_id(), result)
         elif isinstance(result, BundleUpdate):
             self._updates.append(result)
 
         if self._cancelling:
-            self._completion_cb(None)
-        else:
-            GLib.idle_add(self._check_next_update)
+            if not self._checkers:
+                self._completion_cb(None)
+            return
+
+        progress = self._checked / float(self._total_bundles_to_check)
+        self._progress_cb(bundle.get_name(), progress)
+
+        # do it in idle so the UI has a chance to refresh
+        if self._check_sid is None:
+            self._check_sid = GLib.idle_add(self._check_next_updates)
 
-    def _check_next_update(self):
-        total = self._total_bundles_to_check
-        current = total - len(self._bundles_to_check)
-        progress = current / float(total)
+    def _check_next_updates(self):
+        self._check_sid = None
+        if self._cancelling:
+            return False
 
-        if not self._bundles_to_check:
+        if not self._bundles_to_check and not self._checkers:
             self._completion_cb(self._updates)
-            return
+            return False
 
-        bundle = self._bundles_to_check.pop()
-        _logger.debug("Checking %s", bundle.get_bundle_id())
-        self._progress_cb(bundle.get_name(), progress)
-        self._checker.check(bundle)
+        while self._bundles_to_check and \
+                len(self._checkers) < self._max_parallel_checks:
+            bundle = self._bundles_to_check.pop(0)
+            _logger.debug("Checking %s", bundle.get_bundle_id())
+
+            checker = _UpdateChecker(self._session)
+            checker.connect('check-complete', self._check_complete_cb)
+            self._checkers.append(checker)
+            checker.check(bundle, self._check_timeout)
+        return False
 
     def fetch_update_info(self, installed_bundles, auto, progress_cb,
                           completion_cb, error_cb):
@@ -188,12 +257,24 @@ class AsloUpdater(object):
         self._error_cb = error_cb
         self._cancelling = False
         self._updates = []
-        self._bundles_to_check = installed_bundles
+        self._bundles_to_check = list(installed_bundles)
         self._total_bundles_to_check = len(self._bundles_to_check)
-        self._check_next_update()
+        self._checked = 0
+
+        if self._bundles_to_check:
+            self._progress_cb(self._bundles_to_check[0].get_name(), 0)
+        self._check_next_updates()
 
     def cancel(self):
         self._cancelling = True
+        self._bundles_to_check = []
+        if self._check_sid is not None:
+            GLib.source_remove(self._check_sid)
+            self._check_sid = None
+        if not self._checkers:
+            GLib.idle_add(self._completion_cb, None)
+        for checker in list(self._checkers):
+            checker.cancel()
 
     def clean(self):
         pass
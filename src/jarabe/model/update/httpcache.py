@@ -0,0 +1,159 @@
+# Copyright (C) 2016 Sugar Labs
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk HTTP cache for the update metadata fetched by the updater backends.
+
+The body of each response is kept in the profile together with its ETag and
+Last-Modified headers, which are sent back on the next request. When the
+server answers 304 Not Modified the cached body is used instead, and the
+result of parsing it is reused if it was already parsed in this session.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+from gi.repository import GObject
+
+from sugar3 import env
+
+from jarabe.util.downloader import Downloader
+from jarabe.util.downloader import SOUP_STATUS_NOT_MODIFIED
+
+_CACHE_DIR = 'update-cache'
+
+_logger = logging.getLogger('httpcache')
+
+# url -> (validators, parsed result) of the last response parsed
+_parsed_results = {}
+
+
+def _get_cache_path(url):
+    cache_dir = env.get_profile_path(_CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, hashlib.sha1(url).hexdigest())
+
+
+def _read_entry(url):
+    path = _get_cache_path(url)
+    try:
+        with open(path + '.json') as info_file:
+            info = json.load(info_file)
+        if info.get('url') != url:
+            return None
+        with open(path + '.data', 'rb') as data_file:
+            data = data_file.read()
+    except (IOError, OSError, ValueError):
+        return None
+    return info, data
+
+
+def _write_file(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as temp_file:
+        temp_file.write(data)
+    os.rename(temp_path, path)
+
+
+def _write_entry(url, info, data):
+    path = _get_cache_path(url)
+    info = dict(info, url=url)
+    try:
+        # The body is written first, a stale .json would not match it
+        _write_file(path + '.data', data)
+        _write_file(path + '.json', json.dumps(info))
+    except (IOError, OSError):
+        _logger.exception('Error while writing the cache of %s', url)
+
+
+class CachedDownloader(GObject.GObject):
+    """
+    Fetch a URL with a conditional GET, parsing the body with parse_func.
+
+    The 'complete' signal carries the parsed result, or an Exception if the
+    download or the parsing failed.
+    """
+
+    __gsignals__ = {
+        'complete': (GObject.SignalFlags.RUN_FIRST, None, (object,)),
+    }
+
+    def __init__(self, url, parse_func, request_headers=None):
+        GObject.GObject.__init__(self)
+        self._url = url
+        self._parse_func = parse_func
+        self._request_headers = dict(request_headers or {})
+        self._entry = None
+        self._downloader = None
+
+    def download(self):
+        self._entry = _read_entry(self._url)
+        headers = dict(self._request_headers)
+        if self._entry is not None:
+            info = self._entry[0]
+            if info.get('etag'):
+                headers['If-None-Match'] = str(info['etag'])
+            if info.get('last_modified'):
+                headers['If-Modified-Since'] = str(info['last_modified'])
+
+        self._downloader = Downloader(self._url, request_headers=headers)
+        self._downloader.connect('complete', self.__downloader_complete_cb)
+        self._downloader.download()
+
+    def cancel(self):
+        if self._downloader is not None:
+            self._downloader.cancel()
+
+    def __downloader_complete_cb(self, downloader, result):
+        self._downloader = None
+
+        if downloader.get_status_code() == SOUP_STATUS_NOT_MODIFIED and \
+                self._entry is not None:
+            _logger.debug('%s not modified, using the cached copy',
+                          self._url)
+            info, data = self._entry
+        elif isinstance(result, Exception):
+            self.emit('complete', result)
+            return
+        else:
+            data = result.get_data()
+            info = {
+                'etag': downloader.get_response_header('ETag'),
+                'last_modified':
+                    downloader.get_response_header('Last-Modified'),
+            }
+            if info['etag'] or info['last_modified']:
+                _write_entry(self._url, info, data)
+
+        validators = (info.get('etag'), info.get('last_modified'))
+        cached = _parsed_results.get(self._url)
+        if cached is not None and cached[0] == validators and \
+                any(validators):
+            self.emit('complete', cached[1])
+            return
+
+        try:
+            parsed = self._parse_func(data)
+        except Exception as e:
+            _logger.exception('Error while parsing %s', self._url)
+            self.emit('complete', e)
+            return
+
+        _parsed_results[self._url] = (validators, parsed)
+        self.emit('complete', parsed)
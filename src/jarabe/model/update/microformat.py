@@ -26,6 +26,7 @@ import os
 import locale
 import logging
 from tempfile import NamedTemporaryFile
+from threading import Thread
 
 from StringIO import StringIO
 from ConfigParser import ConfigParser
@@ -42,6 +43,7 @@ from sugar3.bundle.bundleversion import NormalizedVersion, InvalidVersionError
 from jarabe.util import httprange
 from jarabe.model import bundleregistry
 from jarabe.model.update import BundleUpdate
+from jarabe.model.update.httpcache import CachedDownloader
 from jarabe.util.downloader import Downloader
 
 _logger = logging.getLogger('microformat')
@@ -202,18 +204,22 @@ class MicroformatUpdater(object):
             self._completion_cb([])
             return
 
-        self._parser = _UpdateHTMLParser(url)
+        self._url = url
+
         # wiki.laptop.org have agresive cache, we set max-age=600
         # to be sure the page is no older than 10 minutes
         request_headers = {'Cache-Control': 'max-age=600'}
-        downloader = Downloader(url, request_headers=request_headers)
-        downloader.connect('got-chunk', self._got_chunk_cb)
+        downloader = CachedDownloader(url, self._parse_page,
+                                      request_headers=request_headers)
         downloader.connect('complete', self._complete_cb)
-        downloader.download_chunked()
+        downloader.download()
         self._progress_cb(None, 0)
 
-    def _got_chunk_cb(self, downloader, data):
-        self._parser.feed(data.get_data())
+    def _parse_page(self, data):
+        parser = _UpdateHTMLParser(self._url)
+        parser.feed(data)
+        parser.close()
+        return parser.results
 
     def _complete_cb(self, downloader, result):
         if isinstance(result, Exception):
@@ -221,17 +227,16 @@ class MicroformatUpdater(object):
             self._error_cb(result)
             return
 
-        self._parser.close()
-        _logger.debug("Found %d activities", len(self._parser.results))
-        self._filter_results()
+        _logger.debug("Found %d activities", len(result))
+        self._filter_results(result)
         self._check_next_update()
 
-    def _filter_results(self):
+    def _filter_results(self, results):
         # Remove updates for which we already have an equivalent or newer
         # version installed. Queue the remaining ones to be checked.
         registry = bundleregistry.get_registry()
         self._bundles_to_check = []
-        for bundle_id, data in self._parser.results.iteritems():
+        for bundle_id, data in results.iteritems():
             # filter optional activities for automatic updates
             if self._auto and data[2] is True:
                 logging.debug('filtered optional activity %s', bundle_id)
@@ -361,6 +366,12 @@ class MetadataLookup(GObject.GObject):
         self._size = None
 
     def run(self):
+        # The lookup blocks on network requests, do it in a thread
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
         # Perform the name lookup, catch any exceptions, and report the result.
         try:
             name = self._do_name_lookup()
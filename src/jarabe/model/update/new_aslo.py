@@ -21,10 +21,14 @@ from sugar3.bundle.bundleversion import NormalizedVersion, InvalidVersionError
 from gi.repository import Gio
 
 from jarabe.model.update import BundleUpdate
-from jarabe.util.downloader import Downloader
+from jarabe.model.update.httpcache import CachedDownloader
 from jarabe import config
 
 
+def _parse_data_json(data):
+    return json.loads(data)['activities']
+
+
 class NewAsloUpdater(object):
     """
     Checks for updates using the new ASLO's update.json file
@@ -51,7 +55,7 @@ class NewAsloUpdater(object):
 
         settings = Gio.Settings('org.sugarlabs.update')
         data_json_url = settings.get_string('new-aslo-url')
-        self._downloader = Downloader(data_json_url)
+        self._downloader = CachedDownloader(data_json_url, _parse_data_json)
         self._downloader.connect('complete',
                                  self.__data_json_download_complete_cb)
         self._downloader.download()
@@ -60,11 +64,10 @@ class NewAsloUpdater(object):
         if self._canceled:
             return
 
-        try:
-            activities = json.loads(result.get_data())['activities']
-        except ValueError:
+        if isinstance(result, Exception):
             self._error_cb('Can not parse loaded update.json')
             return
+        activities = result
 
         updates = []
 
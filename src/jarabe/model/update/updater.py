@@ -18,16 +18,22 @@
 import os
 import logging
 import time
+import hashlib
 import importlib
+from urlparse import urlparse
 
 from gi.repository import GObject
 from gi.repository import GLib
 from gi.repository import Gio
 
 from sugar3.bundle.helpers import bundle_from_archive
+from sugar3 import env
 
 from jarabe.model import bundleregistry
 from jarabe.util.downloader import Downloader
+from jarabe.util.downloader import SOUP_STATUS_RANGE_NOT_SATISFIABLE
+from jarabe.util.downloader import get_validator_path
+from jarabe.util.downloader import soup_status_is_transport_error
 
 _logger = logging.getLogger('Updater')
 _instance = None
@@ -36,6 +42,9 @@ _LAST_UPDATE_KEY = 'last-activity-update'
 _UPDATE_FREQUENCY_KEY = 'auto-update-frequency'
 _UPDATE_BACKEND_KEY = 'backend'
 _URGENT_TRIGGER_FILE = os.path.expanduser('~/.sugar-update')
+_MAX_PARALLEL_DOWNLOADS = 2
+_MAX_DOWNLOAD_RETRIES = 3
+_DOWNLOAD_RETRY_DELAY = 5
 
 STATE_IDLE = 0
 STATE_CHECKING = 1
@@ -78,11 +87,15 @@ class Updater(GObject.GObject):
         self._updates = None
         self._bundles_to_update = None
         self._total_bundles_to_update = 0
-        self._bundle_update = None
         self._bundles_updated = None
         self._bundles_failed = None
 
-        self._downloader = None
+        self._downloaders = {}
+        self._download_progress = {}
+        self._download_retries = {}
+        self._retry_sids = {}
+        self._installs_pending = 0
+        self._bundles_done = 0
         self._cancelling = False
         self._state = STATE_IDLE
         self._auto = False
@@ -137,7 +150,7 @@ class Updater(GObject.GObject):
             raise UpdaterStateException()
 
         if bundle_ids is None:
-            self._bundles_to_update = self._updates
+            self._bundles_to_update = list(self._updates)
         else:
             self._bundles_to_update = []
             for bundle_update in self._updates:
@@ -147,72 +160,123 @@ class Updater(GObject.GObject):
         self._total_bundles_to_update = len(self._bundles_to_update)
         _logger.debug("Starting update of %d activities",
                       self._total_bundles_to_update)
-        self._download_next_update()
-
-    def _download_next_update(self):
-        if self._cancelling:
-            self._finished(True)
-            return
-
-        if len(self._bundles_to_update) == 0:
-            self._finished()
-            return
 
         self._state = STATE_DOWNLOADING
-        self._bundle_update = self._bundles_to_update.pop()
-        _logger.debug("Downloading update for %s",
-                      self._bundle_update.bundle_id)
+        self._downloaders = {}
+        self._download_progress = {}
+        self._download_retries = {}
+        self._retry_sids = {}
+        self._installs_pending = 0
+        self._bundles_done = 0
+        self._remove_stale_downloads()
+        self._download_next_updates()
+
+    def _get_download_path(self, bundle_update):
+        # Stable across sessions so an interrupted download can be resumed
+        url_hash = hashlib.sha1(bundle_update.link).hexdigest()[:8]
+        file_name = os.path.basename(urlparse(bundle_update.link).path)
+        return os.path.join(_get_downloads_dir(),
+                            '%s-%s' % (url_hash, file_name))
+
+    def _remove_stale_downloads(self):
+        # Partial downloads of updates that are not offered anymore
+        downloads_dir = _get_downloads_dir()
+        current = set()
+        for update in self._updates:
+            download_path = self._get_download_path(update)
+            current.add(os.path.basename(download_path))
+            current.add(os.path.basename(get_validator_path(download_path)))
+        for file_name in os.listdir(downloads_dir):
+            if file_name not in current:
+                try:
+                    os.unlink(os.path.join(downloads_dir, file_name))
+                except OSError:
+                    pass
+
+    def _download_next_updates(self):
+        while not self._cancelling and self._bundles_to_update and \
+                len(self._downloaders) + len(self._retry_sids) < \
+                _MAX_PARALLEL_DOWNLOADS:
+            self._start_download(self._bundles_to_update.pop(0))
+        self._check_finished()
+        return False
 
-        total = self._total_bundles_to_update * 2
-        current = total - len(self._bundles_to_update) * 2 - 2
-        progress = current / float(total)
-        self.emit('progress', self._state, self._bundle_update.name, progress)
+    def _start_download(self, bundle_update):
+        _logger.debug("Downloading update for %s", bundle_update.bundle_id)
+
+        downloader = Downloader(bundle_update.link)
+        downloader.connect('progress', self.__downloader_progress_cb,
+                           bundle_update)
+        downloader.connect('complete', self.__downloader_complete_cb,
+                           bundle_update)
+        self._downloaders[bundle_update.bundle_id] = downloader
+        downloader.download_to_file(self._get_download_path(bundle_update))
+        self._emit_progress(bundle_update.name)
+
+    def _retry_download(self, bundle_update):
+        del self._retry_sids[bundle_update.bundle_id]
+        self._start_download(bundle_update)
+        return False
 
-        self._downloader = Downloader(self._bundle_update.link)
-        self._downloader.connect('progress', self.__downloader_progress_cb)
-        self._downloader.connect('complete', self.__downloader_complete_cb)
-        self._downloader.download_to_temp()
+    def __downloader_complete_cb(self, downloader, result, bundle_update):
+        del self._downloaders[bundle_update.bundle_id]
 
-    def __downloader_complete_cb(self, downloader, result):
         if self._cancelling:
-            self._cleanup_downloader()
-            self._finished(True)
+            self._check_finished()
             return
 
         if isinstance(result, Exception):
+            retries = self._download_retries.get(bundle_update.bundle_id, 0)
+            if retries < _MAX_DOWNLOAD_RETRIES and \
+                    _is_download_error_transient(downloader):
+                _logger.warning('Error downloading update, resuming: %s',
+                                result)
+                self._download_retries[bundle_update.bundle_id] = retries + 1
+                self._retry_sids[bundle_update.bundle_id] = \
+                    GLib.timeout_add_seconds(_DOWNLOAD_RETRY_DELAY,
+                                             self._retry_download,
+                                             bundle_update)
+                return
+
             _logger.error('Error downloading update: %s', result)
-            self._cleanup_downloader()
-            self._bundles_failed.append(self._bundle_update)
-            self._download_next_update()
+            self._bundles_failed.append(bundle_update)
+            self._bundle_done(bundle_update.bundle_id, bundle_update.name)
         else:
-            self._install_update(self._bundle_update,
-                                 self._downloader.get_local_file_path())
-            self._downloader = None
+            self._install_update(bundle_update,
+                                 downloader.get_local_file_path())
 
-    def __downloader_progress_cb(self, downloader, progress):
-        total = self._total_bundles_to_update * 2
-        current = total - len(self._bundles_to_update) * 2 - 2 + progress
-        progress = current / float(total)
-        self.emit('progress', self._state, self._bundle_update.name, progress)
+        # do it in idle so the UI has a chance to refresh
+        GLib.idle_add(self._download_next_updates)
 
-    def _install_update(self, bundle_update, local_file_path):
-        self._state = STATE_UPDATING
-        total = self._total_bundles_to_update
-        current = total - len(self._bundles_to_update) - 0.5
-        progress = current / float(total)
+    def __downloader_progress_cb(self, downloader, progress, bundle_update):
+        self._download_progress[bundle_update.bundle_id] = progress
+        self._emit_progress(bundle_update.name)
 
+    def _install_update(self, bundle_update, local_file_path):
+        self._download_progress[bundle_update.bundle_id] = 1
         _logger.debug("Installing update for %s", bundle_update.bundle_id)
-        self.emit('progress', self._state, bundle_update.name, progress)
+        self._emit_progress(bundle_update.name)
 
-        current += 0.5
-        bundle = bundle_from_archive(local_file_path)
+        try:
+            bundle = bundle_from_archive(local_file_path)
+        except Exception:
+            _logger.exception('Error opening update for %s',
+                              bundle_update.bundle_id)
+            os.unlink(local_file_path)
+            self._bundles_failed.append(bundle_update)
+            self._bundle_done(bundle_update.bundle_id, bundle_update.name)
+            return
+
+        # The installation runs in the install queue of the registry, while
+        # the next updates are downloaded
+        self._installs_pending += 1
         registry = bundleregistry.get_registry()
-        registry.install_async(bundle, self._bundle_installed_cb, current)
+        registry.install_async(bundle, self._bundle_installed_cb,
+                               bundle_update)
 
-    def _bundle_installed_cb(self, bundle, result, progress):
+    def _bundle_installed_cb(self, bundle, result, bundle_update):
         _logger.debug("%s installed: %r", bundle.get_bundle_id(), result)
-        progress = progress / float(self._total_bundles_to_update)
-        self.emit('progress', self._state, bundle.get_name(), progress)
+        self._installs_pending -= 1
 
         # Remove downloaded bundle archive
         try:
@@ -225,8 +289,33 @@ class Updater(GObject.GObject):
         else:
             self._bundles_failed.append(bundle)
 
-        # do it in idle so the UI has a chance to refresh
-        GLib.idle_add(self._download_next_update)
+        self._bundle_done(bundle_update.bundle_id, bundle.get_name())
+        self._check_finished()
+
+    def _bundle_done(self, bundle_id, name):
+        self._download_progress[bundle_id] = 1
+        self._bundles_done += 1
+        self._emit_progress(name)
+
+    def _emit_progress(self, name):
+        if self._downloaders or self._retry_sids or self._bundles_to_update:
+            self._state = STATE_DOWNLOADING
+        else:
+            self._state = STATE_UPDATING
+
+        # Downloading and installing each take half of the progress
+        total = self._total_bundles_to_update * 2
+        current = sum(self._download_progress.values()) + self._bundles_done
+        self.emit('progress', self._state, name, current / float(total))
+
+    def _check_finished(self):
+        if self._state not in (STATE_DOWNLOADING, STATE_UPDATING):
+            return
+        if self._downloaders or self._retry_sids or self._installs_pending:
+            return
+        if self._bundles_to_update and not self._cancelling:
+            return
+        self._finished(self._cancelling)
 
     def _finished(self, cancelled=False):
         self._state = STATE_IDLE
@@ -251,24 +340,34 @@ class Updater(GObject.GObject):
 
         self._cancelling = True
         self._model.cancel()
-        if self._downloader:
-            self._downloader.cancel()
 
-    def _cleanup_downloader(self):
-        if self._downloader is None:
-            return
-
-        file_path = self._downloader.get_local_file_path()
-        if file_path is not None:
-            try:
-                os.unlink(file_path)
-            except OSError:
-                pass
+        # Partial downloads are kept, to be resumed by the next update
+        for sid in self._retry_sids.values():
+            GLib.source_remove(sid)
+        self._retry_sids = {}
+        for downloader in self._downloaders.values():
+            downloader.cancel()
+        self._check_finished()
 
     def clean(self):
         self._model.clean()
 
 
+def _is_download_error_transient(downloader):
+    status = downloader.get_status_code()
+    # A range not satisfiable reply discarded the partial download, so
+    # the next attempt starts over
+    return soup_status_is_transport_error(status) or status >= 500 or \
+        status == SOUP_STATUS_RANGE_NOT_SATISFIABLE
+
+
+def _get_downloads_dir():
+    downloads_dir = os.path.join(env.get_profile_path(), 'data', 'updates')
+    if not os.path.isdir(downloads_dir):
+        os.makedirs(downloads_dir)
+    return downloads_dir
+
+
 def get_instance():
     global _instance
     if _instance is None:
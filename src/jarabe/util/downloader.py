@@ -31,12 +31,29 @@ from sugar3 import env
 _session = None
 
 SOUP_STATUS_CANCELLED = 1
+SOUP_STATUS_PARTIAL_CONTENT = 206
+SOUP_STATUS_NOT_MODIFIED = 304
+SOUP_STATUS_RANGE_NOT_SATISFIABLE = 416
+
+# Stored next to a partial download_to_file() download, the ETag or
+# Last-Modified value of the contents it holds the beginning of
+_VALIDATOR_SUFFIX = '.validator'
 
 
 def soup_status_is_successful(status):
     return status >= 200 and status < 300
 
 
+def soup_status_is_transport_error(status):
+    # libsoup uses the codes below 100 for errors that happened before
+    # getting any HTTP response, like failing to connect or a timeout
+    return status > SOUP_STATUS_CANCELLED and status < 100
+
+
+def get_validator_path(file_path):
+    return file_path + _VALIDATOR_SUFFIX
+
+
 def get_soup_session():
     global _session
     if _session is None:
@@ -72,6 +89,9 @@ class Downloader(GObject.GObject):
         self._status_code = None
         self._output_file = None
         self._output_stream = None
+        self._resume_offset = 0
+        self._validator_path = None
+        self._already_complete = False
         self._message = None
         self._request_headers = request_headers
 
@@ -98,6 +118,35 @@ class Downloader(GObject.GObject):
             Gio.FileCreateFlags.PRIVATE, None)
         self.download_chunked()
 
+    def download_to_file(self, file_path):
+        """
+        Download the contents of the provided URL to file_path. If the file
+        already exists, as left by an interrupted download, only the rest of
+        the contents is requested and appended to it, provided the server
+        still has the same version of them; otherwise the file is
+        overwritten. Upon completion, a successful download is indicated by
+        a result of None in the complete signal parameters.
+        """
+        self._output_file = Gio.File.new_for_path(file_path)
+        self._validator_path = get_validator_path(file_path)
+        validator = None
+        try:
+            self._resume_offset = os.path.getsize(file_path)
+            with open(self._validator_path) as f:
+                validator = f.read().strip()
+        except (IOError, OSError):
+            pass
+        if not validator:
+            # no way to tell if the server contents changed since
+            self._resume_offset = 0
+
+        self._setup_message()
+        self._message.response_body.set_accumulate(False)
+        if self._resume_offset > 0:
+            self._message.request_headers.set_range(self._resume_offset, -1)
+            self._message.request_headers.replace('If-Range', validator)
+        self._session.queue_message(self._message, self._message_cb, None)
+
     def download_chunked(self):
         """
         Download the contents of the provided URL into memory. The download
@@ -130,6 +179,16 @@ class Downloader(GObject.GObject):
         self._setup_message("HEAD")
         self._session.queue_message(self._message, self._message_cb, None)
 
+    def get_status_code(self):
+        """The HTTP status code of the response, once complete"""
+        return self._status_code
+
+    def get_response_header(self, name):
+        """The value of a header of the response, or None"""
+        if self._message is None:
+            return None
+        return self._message.response_headers.get_one(name)
+
     def _message_cb(self, session, message, user_data):
         self._status_code = message.status_code
         self._check_if_finished()
@@ -142,6 +201,56 @@ class Downloader(GObject.GObject):
         if soup_status_is_successful(message.status_code):
             self._total_size = message.response_headers.get_content_length()
 
+        if self._output_file is None or self._output_stream is not None:
+            return
+
+        # download_to_file(), open the file now that we know whether the
+        # server is sending the rest of the contents or all of them
+        if message.status_code == SOUP_STATUS_PARTIAL_CONTENT:
+            self._output_stream = self._output_file.append_to(
+                Gio.FileCreateFlags.PRIVATE, None)
+            self._downloaded_size = self._resume_offset
+            self._total_size += self._resume_offset
+        elif soup_status_is_successful(message.status_code):
+            # A full response, because the contents changed or the server
+            # ignored the range, overwrites what was downloaded before
+            self._output_stream = self._output_file.replace(
+                None, False, Gio.FileCreateFlags.PRIVATE, None)
+            self._save_validator(message)
+        elif message.status_code == SOUP_STATUS_RANGE_NOT_SATISFIABLE:
+            found, start_, end_, total = \
+                message.response_headers.get_content_range()
+            if found and total == self._resume_offset:
+                # The whole file had been downloaded already
+                self._already_complete = True
+                return
+            # The partial file doesn't match the remote one, start over
+            # the next time
+            self._remove_partial_file()
+
+    def _save_validator(self, message):
+        etag = message.response_headers.get_one('ETag')
+        if etag is not None and etag.startswith('W/'):
+            # If-Range only accepts strong entity tags
+            etag = None
+        validator = etag or \
+            message.response_headers.get_one('Last-Modified')
+        try:
+            if validator:
+                with open(self._validator_path, 'w') as f:
+                    f.write(validator)
+            elif os.path.exists(self._validator_path):
+                os.unlink(self._validator_path)
+        except (IOError, OSError):
+            pass
+
+    def _remove_partial_file(self):
+        for path in (self._output_file.get_path(), self._validator_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
     def _got_chunk_cb(self, message, buf):
         if self._cancelling or \
                 not soup_status_is_successful(message.status_code):
@@ -167,8 +276,17 @@ class Downloader(GObject.GObject):
         if self._output_stream:
             self._output_stream.close(None)
 
+        succeeded = self._already_complete or \
+            soup_status_is_successful(self._status_code)
+        if succeeded and self._validator_path is not None:
+            # download_to_file() done, nothing left to resume
+            try:
+                os.unlink(self._validator_path)
+            except OSError:
+                pass
+
         result = None
-        if soup_status_is_successful(self._status_code):
+        if succeeded:
             if self._message.method == "HEAD":
                 # this is a get_size request
                 result = self._total_size
@@ -17,13 +17,31 @@
 """
 A simple HTTP-based file-like object that supports seek() via the HTTP
 Range header. This means it doesn't have to download the whole file just
-to read a small part of it. Uses Downloader as a backend, and runs the
-regular main loop while waiting for data.
+to read a small part of it. Uses Downloader as a backend.
+
+Data is fetched in aligned blocks that are kept in memory, reading a few
+blocks ahead and fetching runs of missing blocks with a single request.
+The first request fetches the tail of the file, where zip archives keep
+their central directory, and learns the size of the file from it.
+
+The requests are made from the main loop, while the reading thread waits
+for them, so the object must be used from a thread other than the one
+running the main loop.
 """
 
-from gi.repository import Gtk
+import re
+from threading import Event
+
+from gi.repository import GLib
 
 from jarabe.util.downloader import Downloader
+from jarabe.util.downloader import SOUP_STATUS_PARTIAL_CONTENT
+
+_BLOCK_SIZE = 32 * 1024
+_READ_AHEAD_BLOCKS = 2
+_TAIL_SIZE = 4 * _BLOCK_SIZE
+
+_CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+)')
 
 
 class _HttpRangeFileObject(object):
@@ -32,48 +50,126 @@ class _HttpRangeFileObject(object):
         self._url = url
         self._size = None
         self._offset = 0
+        self._blocks = {}
+        self._downloader = None
         self._result = None
-        self._complete = False
+        self._complete = Event()
+
+    def _start_download(self, method, kwargs):
+        # Runs in the main loop
+        self._downloader = Downloader(self._url)
+        self._downloader.connect('complete', self._downloader_complete_cb)
+        getattr(self._downloader, method)(**kwargs)
+        return False
 
     def _downloader_complete_cb(self, downloader, result):
         self._result = result
-        self._complete = True
+        self._complete.set()
 
     def _do_download(self, method, **kwargs):
-        # set up Downloader, call method on it with given kwargs, wait for
-        # response
-        self._complete = False
-        downloader = Downloader(self._url)
-        downloader.connect('complete', self._downloader_complete_cb)
-        getattr(downloader, method)(**kwargs)
-
-        while not self._complete:
-            Gtk.main_iteration()
+        # set up Downloader in the main loop, call method on it with given
+        # kwargs, wait for response
+        self._complete.clear()
+        GLib.idle_add(self._start_download, method, kwargs)
+        self._complete.wait()
 
         if isinstance(self._result, Exception):
             raise self._result
+        return self._downloader
+
+    def _store_blocks(self, start, data):
+        # Keep the blocks fully contained in data, the last block of the file
+        # counts as full
+        end = start + len(data)
+        first = (start + _BLOCK_SIZE - 1) // _BLOCK_SIZE
+        block_start = first * _BLOCK_SIZE
+        while block_start < end:
+            block_end = min(block_start + _BLOCK_SIZE, self._size)
+            if block_end > end:
+                break
+            self._blocks[block_start // _BLOCK_SIZE] = \
+                data[block_start - start:block_end - start]
+            block_start += _BLOCK_SIZE
+
+    def _fetch_tail(self):
+        downloader = self._do_download('download', start=-_TAIL_SIZE,
+                                       end=-1)
+        data = self._result.get_data()
+        if downloader.get_status_code() != SOUP_STATUS_PARTIAL_CONTENT:
+            # The server sent the whole file
+            self._size = len(data)
+            self._store_blocks(0, data)
+            return
+
+        match = _CONTENT_RANGE_RE.match(
+            downloader.get_response_header('Content-Range') or '')
+        if match is None:
+            self._do_download('get_size')
+            if self._result is None:
+                raise IOError("No content length header")
+            self._size = self._result
+            return
+
+        start, end_, size = [int(group) for group in match.groups()]
+        self._size = size
+        self._store_blocks(start, data)
+
+    def _fetch_blocks(self, first, last):
+        # Fetch the blocks from first to last that are not cached, together
+        # with the following ones, with one request per run of missing blocks
+        last_block = (self.size() - 1) // _BLOCK_SIZE
+        last = min(last + _READ_AHEAD_BLOCKS, last_block)
+
+        index = first
+        while index <= last:
+            if index in self._blocks:
+                index += 1
+                continue
+            run_start = index
+            while index <= last and index not in self._blocks:
+                index += 1
+
+            start = run_start * _BLOCK_SIZE
+            end = min(index * _BLOCK_SIZE, self._size)
+            downloader = self._do_download('download', start=start,
+                                           end=end - 1)
+            data = self._result.get_data()
+            if downloader.get_status_code() != SOUP_STATUS_PARTIAL_CONTENT:
+                # The server sent the whole file
+                self._store_blocks(0, data)
+            else:
+                self._store_blocks(start, data)
 
     def tell(self):
         return self._offset
 
     def size(self):
         if self._size is None:
-            self._do_download('get_size')
-            if self._result is None:
-                raise IOError("No content length header")
-            self._size = self._result
+            self._fetch_tail()
         return self._size
 
     def read(self, size=-1):
+        file_size = self.size()
         if size < 0:
-            end = self.size()
+            end = file_size
         else:
-            end = self._offset + size
-
-        self._complete = False
-
-        self._do_download('download', start=self._offset, end=end - 1)
-        data = self._result.get_data()
+            end = min(self._offset + size, file_size)
+        if self._offset >= end:
+            return ''
+
+        first = self._offset // _BLOCK_SIZE
+        last = (end - 1) // _BLOCK_SIZE
+        if any(index not in self._blocks for index in xrange(first,
+                                                             last + 1)):
+            self._fetch_blocks(first, last)
+
+        blocks = [self._blocks.get(index)
+                  for index in xrange(first, last + 1)]
+        if None in blocks:
+            raise IOError('Short read from %s' % self._url)
+        data = ''.join(blocks)
+        skip = self._offset - first * _BLOCK_SIZE
+        data = data[skip:skip + end - self._offset]
         self._offset += len(data)
         return data
 
@@ -13,8 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import unittest
+import os
 import sys
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from gi.repository import Gtk
 
 from jarabe import config
 
@@ -23,6 +29,7 @@ sys.path.append(config.ext_path)
 
 from cpsection.backup.backupmanager import BackupManager
 from cpsection.backup.backends.backend_tools import Backend
+from cpsection.backup.backends import volume
 
 
 class TestBackup(unittest.TestCase):
@@ -45,3 +52,146 @@ class TestBackup(unittest.TestCase):
 
     def test_need_stop_activities(self):
         self.assertFalse(self.manager.need_stop_activities())
+
+
+class TestVolumeBackend(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._datastore_path = os.path.join(self._temp_dir, 'datastore')
+        self._volume = os.path.join(self._temp_dir, 'volume')
+        os.makedirs(self._volume)
+
+        self._get_datastore_path = volume._get_datastore_path
+        volume._get_datastore_path = lambda: self._datastore_path
+
+        # enough data for the archive to have several gzip members
+        self._object_ids = ['%02x%s' % (i, 'a' * 34) for i in range(12)]
+        for i, object_id in enumerate(self._object_ids):
+            object_path = os.path.join(self._datastore_path, object_id[:2],
+                                       object_id)
+            os.makedirs(os.path.join(object_path, 'metadata'))
+            with open(os.path.join(object_path, 'metadata', 'title'),
+                      'w') as f:
+                f.write('Object %d' % i)
+            with open(os.path.join(object_path, 'data'), 'w') as f:
+                f.write(os.urandom(200000))
+        self._contents = self._read_datastore()
+
+    def tearDown(self):
+        volume._get_datastore_path = self._get_datastore_path
+        shutil.rmtree(self._temp_dir)
+
+    def _read_datastore(self):
+        contents = {}
+        for dir_path, dir_names, file_names in os.walk(self._datastore_path):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                with open(path) as f:
+                    contents[os.path.relpath(path, self._datastore_path)] = \
+                        f.read()
+        return contents
+
+    def _get_size(self):
+        return sum(len(data) for data in self._contents.values())
+
+    def _backup(self):
+        backup = volume.Backup()
+        backup._checkpoint = os.path.join(self._volume, 'test.xob')
+        backup._cancelled = False
+        backup._uncompressed_size = self._get_size()
+        self.assertTrue(backup._backup_full())
+        return backup._checkpoint
+
+    def _restore(self, checkpoint, objects=None):
+        option = {'volume': self._volume, 'checkpoint': checkpoint}
+        if objects is not None:
+            option['objects'] = objects
+        restore = volume.Restore()
+        restore.verify_preconditions(option)
+
+        result = []
+        restore.connect('finished', lambda restore: result.append(None))
+        restore.connect('failed',
+                        lambda restore, message: result.append(message))
+        restore.start()
+        while not result:
+            Gtk.main_iteration()
+        return result[0]
+
+    def _erase_datastore(self):
+        shutil.rmtree(self._datastore_path)
+        os.makedirs(self._datastore_path)
+
+    def test_backup_restore(self):
+        checkpoint = self._backup()
+        index = volume._read_index(checkpoint)
+        self.assertIsNotNone(index)
+        self.assertEqual(index['size'],
+                         volume._get_checkpoint_size(checkpoint))
+        # still a regular tar.gz file
+        with tarfile.open(checkpoint, 'r:gz') as tar:
+            self.assertEqual(len(tar.getnames()), len(index['entries']))
+
+        self._erase_datastore()
+        self.assertIsNone(self._restore(checkpoint))
+        self.assertEqual(self._read_datastore(), self._contents)
+
+    def test_restore_objects_from_index(self):
+        checkpoint = self._backup()
+        index = volume._read_index(checkpoint)
+        self.assertTrue(volume._check_index(checkpoint, index))
+
+        selected = self._object_ids[5:7]
+        for object_id in self._object_ids[:8]:
+            shutil.rmtree(os.path.join(self._datastore_path, object_id[:2],
+                                       object_id))
+        self.assertIsNone(self._restore(checkpoint, selected))
+
+        contents = self._read_datastore()
+        for path, data in self._contents.items():
+            object_id = path.split(os.sep)[1]
+            if object_id in selected or object_id not in \
+                    self._object_ids[:8]:
+                self.assertEqual(contents.get(path), data)
+            else:
+                self.assertNotIn(path, contents)
+
+    def test_restore_without_index(self):
+        checkpoint = os.path.join(self._volume, 'old.xob')
+        with tarfile.open(checkpoint, 'w:gz') as tar:
+            tar.add(self._datastore_path,
+                    arcname=self._datastore_path.lstrip(os.sep))
+        self.assertIsNone(volume._read_index(checkpoint))
+
+        self._erase_datastore()
+        self.assertIsNone(self._restore(checkpoint))
+        self.assertEqual(self._read_datastore(), self._contents)
+
+    def test_restore_corrupt_footer(self):
+        checkpoint = self._backup()
+        with open(checkpoint, 'r+b') as f:
+            f.seek(-volume.INDEX_FOOTER_SIZE + 12, os.SEEK_END)
+            f.write('XX')
+        self.assertIsNone(volume._read_index(checkpoint))
+
+        self._erase_datastore()
+        self.assertIsNone(self._restore(checkpoint))
+        self.assertEqual(self._read_datastore(), self._contents)
+
+    def test_restore_missing_object(self):
+        backup = volume.Backup()
+        backup._volume = self._volume
+        backup._checkpoint = os.path.join(self._volume, 'test.xobm')
+        backup._cancelled = False
+        backup._uncompressed_size = self._get_size()
+        self.assertTrue(backup._backup_incremental())
+
+        manifest = volume._read_manifest(backup._checkpoint)
+        store_path = os.path.join(self._volume, manifest['store'])
+        os.remove(volume._get_object_path(store_path,
+                                          manifest['files'][-1]['hash']))
+
+        self.assertIsNotNone(self._restore(backup._checkpoint))
+        # the Journal is left alone
+        self.assertEqual(self._read_datastore(), self._contents)
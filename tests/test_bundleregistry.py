@@ -61,3 +61,14 @@ class TestBundleRegistry(unittest.TestCase):
         registry.install(bundle)
         installed_bundle = registry.get_bundle("org.sugarlabs.MyActivity")
         self.assertIsNotNone(installed_bundle)
+
+    def test_uninstall_activity(self):
+        registry = bundleregistry.get_registry()
+        bundle = bundle_from_archive(os.path.join(data_dir, 'activity-1.xo'))
+        registry.install(bundle)
+        installed_bundle = registry.get_bundle("org.sugarlabs.MyActivity")
+        self.assertTrue(registry.is_installed(bundle))
+
+        registry.uninstall(installed_bundle)
+        self.assertIsNone(registry.get_bundle("org.sugarlabs.MyActivity"))
+        self.assertFalse(registry.is_installed(bundle))